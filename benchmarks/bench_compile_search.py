@@ -0,0 +1,48 @@
+"""
+Microbenchmark of compile_search, the structured POST search compiler, comparing a
+first compile with the memoized lookup of a repeated search. Exits with status 1 when
+a repeated search is not served from compiled_searches.
+
+Run from the directory holding dmtconfig.py:
+
+    python benchmarks/bench_compile_search.py [number]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import dmtclearinghouse as dmt
+
+SEARCHES = {
+    "one": [{"group":"and","and":[{"string":"Data management","field":"keywords","type":"match"}]}],
+    "facets": [{"group":"and","and":[{"string":"FAIR Data Principles","field":"ed_framework","type":"match"},{"string":"Research scientist","field":"target_audience","type":"match"},{"string":"Lesson","field":"type","type":"match"}]}],
+    "mixed": [{"group":"and","and":[{"string":"data archiving","field":"title","type":"simple"},{"string":"Aerospace","field":"subject","type":"match"}]},
+              {"group":"not","not":[{"string":"Webinar","field":"type","type":"match"}]},
+              {"group":"or","or":[{"string":"NASA","field":"publisher","type":"match"},{"string":"USGS","field":"publisher","type":"match"}]}],
+}
+
+
+def main():
+    number=int(sys.argv[1]) if len(sys.argv)>1 else 20000
+    report={}
+    failed=False
+    for name,search in SEARCHES.items():
+        dmt.compiled_searches.clear()
+        first=dmt.compile_search(search)
+        #A repeated search must return the memoized tuple itself.
+        hit=dmt.compile_search(search) is first
+        failed=failed or not hit
+        def cold():
+            dmt.compiled_searches.clear()
+            dmt.compile_search(search)
+        compiled=min(timeit.repeat(cold,number=number,repeat=5))/number
+        memoized=min(timeit.repeat(lambda: dmt.compile_search(search),number=number,repeat=5))/number
+        report[name]={"compile_microseconds":round(compiled*1e6,2),"memoized_microseconds":round(memoized*1e6,2),"memoized":hit}
+    print(json.dumps(report))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
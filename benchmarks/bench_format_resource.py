@@ -0,0 +1,117 @@
+"""
+Compares the throughput of format_resource with the implementation it replaced
+on synthetic Solr responses.
+
+Run from the directory holding dmtconfig.py:
+
+    python benchmarks/bench_format_resource.py [rows] [repeat]
+"""
+import copy
+import json
+import os
+import sys
+import time
+
+import pysolr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import dmtclearinghouse as dmt
+
+
+def legacy_format_resource(results):
+    #format_resource before the FieldPlan rewrite.
+    returnval= json.loads('{ "documentation":"'+dmt.request.host_url+'api/resources/documentation.html","results":[], "facets":{}}')
+    for result in results:
+        result.pop('_version_', None)
+        result.pop('status', None)
+        list_keys = list(result.keys())
+        for k in list_keys:
+            if k.startswith('facet_'):
+                result.pop(k)
+        if "contributors.firstname" in result.keys():
+            result['contributors']=[]
+            if result["contributors.firstname"]:
+                for i in range(len(result["contributors.firstname"])):
+                    contributor=json.loads('{}')
+                    contributor['firstname']=result["contributors.firstname"][i]
+                    if "contributors.lastname" in result.keys():
+                        contributor['lastname']=result["contributors.lastname"][i]
+                    if "contributors.type" in result.keys():
+                        contributor['type']=result["contributors.type"][i]
+                    result['contributors'].append(contributor)
+        if "contributor_orgs.name" in result.keys():
+            result['contributor_orgs']=[]
+            for i in range(len(result["contributor_orgs.name"])):
+                contributor=json.loads('{}')
+                contributor['name']=result["contributor_orgs.name"][i]
+                if "contributor_orgs.type" in result.keys():
+                    contributor['type']=result["contributor_orgs.type"][i]
+                result['contributor_orgs'].append(contributor)
+        result.pop('contributor_orgs.type', None)
+        result.pop('contributor_orgs.name', None)
+        result.pop('contributors.firstname', None)
+        result.pop('contributors.lastname', None)
+        result.pop('contributors.type', None)
+        returnval['results'].append(result)
+    if "facet_fields" in results.facets.keys():
+        for rf in dmt.resources_facets:
+            rfobject={}
+            if rf in results.facets['facet_fields'].keys():
+                for value,number in zip(results.facets['facet_fields'][rf][0::2], results.facets['facet_fields'][rf][1::2]):
+                    if number>0:
+                        rfobject[value]=number
+            returnval['facets'][rf.replace('facet_','')]=rfobject
+    returnval['hits-total']=results.hits
+    returnval['hits-returned']=len(results)
+    return returnval
+
+
+def synthetic_response(rows, legacy=True):
+    docs=[]
+    for i in range(rows):
+        doc={"id":"resource-%d"%i,"title":["Title %d"%i],"url":["https://example.org/%d"%i],
+             "abstract.data":["An abstract about research data management %d"%i],
+             "keywords":["data","management","metadata"],"status":[True],"_version_":1700000000000000000+i,
+             "contributors.firstname":["Amber","Nancy","Karl"],"contributors.lastname":["Budden","Hoebelheinrich","Benedict"],
+             "contributors.type":["author","author","editor"],"contributor_orgs.name":["DataONE","ESIP"],"contributor_orgs.type":["publisher","sponsor"]}
+        if legacy:
+            for rf in dmt.resources_facets:
+                doc[rf]=["value"]
+        docs.append(doc)
+    #The new path requests facet.mincount=1, so Solr leaves out zero counts.
+    counts=["a%d"%i for i in range(30)]
+    facet_fields={rf:[value for j,name in enumerate(counts) for value in (name,(j%3)*4) if legacy or j%3] for rf in dmt.resources_facets}
+    return {"response":{"numFound":rows*10,"start":0,"docs":docs},"facet_counts":{"facet_fields":facet_fields}}
+
+
+def best_time(format_function, response, repeat):
+    #Documents are modified in place, so every run formats a fresh copy made outside the timing.
+    best=None
+    for i in range(repeat):
+        results=pysolr.Results(copy.deepcopy(response))
+        started=time.perf_counter()
+        format_function(results)
+        elapsed=time.perf_counter()-started
+        if best is None or elapsed<best:
+            best=elapsed
+    return best
+
+
+def main():
+    rows=int(sys.argv[1]) if len(sys.argv)>1 else 300
+    repeat=int(sys.argv[2]) if len(sys.argv)>2 else 50
+    fieldnames=list(synthetic_response(1)["response"]["docs"][0].keys())
+    plan=dmt.FieldPlan([name for name in fieldnames if name!="_version_"])
+    with dmt.app.test_request_context("/api/resources/"):
+        dmt.schema_cache.set(("plan","learningresources"),plan)
+        #The legacy path gets facet_ copies and zero counts, the new path requests fl and facet.mincount.
+        legacy_response=synthetic_response(rows)
+        new_response=synthetic_response(rows,legacy=False)
+        assert legacy_format_resource(pysolr.Results(copy.deepcopy(legacy_response)))==dmt.format_resource(pysolr.Results(copy.deepcopy(new_response)))
+        legacy=best_time(legacy_format_resource,legacy_response,repeat)
+        new=best_time(dmt.format_resource,new_response,repeat)
+    print(json.dumps({"rows":rows,"legacy_docs_per_second":round(rows/legacy),"new_docs_per_second":round(rows/new),"speedup":round(legacy/new,2)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Microbenchmark of the GET /api/resources/ argument parsing, comparing the
+table driven build_get_query with the 34 append_searchstring calls it replaced.
+
+Run from the directory holding dmtconfig.py:
+
+    python benchmarks/bench_get_parsing.py [number]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import dmtclearinghouse as dmt
+
+LEGACY_FIELDS = ["title","url","access_cost","submitter_name","submitter_email","author","author_org","contact","contact_org","abstract.data","subject","keywords","licence","usage_rights","citation.data","locator.data","locator.type","publisher","version","created","published","access_features","language_primary","languages_secondary","ed_framework","ed_framework_dataone","ed_framework_fair","target_audience","purpose","completion_time","media_type","type","author","id"]
+
+QUERIES = {
+    "none": "",
+    "one": "keywords=%22Data+management%22",
+    "facets": "type=%22Learning+Activity%22&subject=Aerospace&language_primary=es&limit=20",
+    "many": "title=DataONE&author=Nhoebelheinrich&publisher=%22Oak+Ridge+National+Laboratory%22&target_audience=%22Research+scientist%22&purpose=%22Professional+Development%22&media_type=%22Moving+Image%22&limit=50",
+}
+
+
+def append_searchstring(searchstring,request,name):
+    if request.args.get(name):
+        if ":" not in request.args.get(name):
+            return searchstring+" AND "+name+":"+request.args.get(name)
+        else:
+            return searchstring
+    else:
+        return searchstring
+
+
+def legacy_build_get_query(request):
+    searchstring="status:true"
+    for name in LEGACY_FIELDS:
+        searchstring=append_searchstring(searchstring,request,name)
+    return searchstring
+
+
+def main():
+    number=int(sys.argv[1]) if len(sys.argv)>1 else 20000
+    report={}
+    for name,query in QUERIES.items():
+        with dmt.app.test_request_context("/api/resources/?"+query) as context:
+            request=context.request
+            legacy=min(timeit.repeat(lambda: legacy_build_get_query(request),number=number,repeat=5))/number
+            new=min(timeit.repeat(lambda: dmt.build_get_query(request.args),number=number,repeat=5))/number
+        report[name]={"legacy_microseconds":round(legacy*1e6,2),"new_microseconds":round(new*1e6,2),"speedup":round(legacy/new,2)}
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Measures the startup cost of a worker: importing dmtclearinghouse, create_app(warm=True)
+and the first search, each in a fresh interpreter, against the fake Solr of
+benchmarks/fakesolr.py. Also lists the heavy dependencies loaded by the import alone,
+which should be none of them.
+
+    python benchmarks/bench_startup.py [--runs 5] [--max-import-seconds 1.0]
+
+Prints a JSON report and exits with status 1 when a heavy dependency is imported eagerly
+or the median import time exceeds --max-import-seconds.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+import fakesolr
+
+HEAVY = ["weasyprint","pysolr","requests","drupal_hash_utility","docstring_parser"]
+
+CONFIG = """
+class DevConfig(object):
+    SECRET_KEY = 'startup'
+    SOLR_ADDRESS = 'http://127.0.0.1:%(port)d/solr/'
+    SCHEMA_CACHE_STAMP = %(tmp)r+'/schema.stamp'
+    RESULT_CACHE_STAMP = %(tmp)r+'/results.stamp'
+    VOCABULARY_STAMP = %(tmp)r+'/vocabularies.stamp'
+"""
+
+#Each probe runs in a new interpreter and prints one JSON object.
+PROBE = """
+import json, sys, time
+started=time.perf_counter()
+import dmtclearinghouse as dmt
+imported=time.perf_counter()
+report={"import_seconds":imported-started,"heavy_modules":[name for name in %(heavy)r if name in sys.modules]}
+if %(warm)r:
+    dmt.create_app(warm=True)
+    report["warm_seconds"]=time.perf_counter()-imported
+client=dmt.app.test_client()
+requested=time.perf_counter()
+status=client.get("/api/resources/?limit=10").status_code
+report["first_request_seconds"]=time.perf_counter()-requested
+report["first_request_status"]=status
+print(json.dumps(report))
+"""
+
+
+def probe(env,warm):
+    output=subprocess.run([sys.executable,"-c",PROBE%{"heavy":HEAVY,"warm":warm}],env=env,check=True,capture_output=True,text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs,key):
+    values=[run[key] for run in runs if key in run]
+    if not values:
+        return None
+    return {"median":round(statistics.median(values),4),"min":round(min(values),4),"max":round(max(values),4)}
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs",type=int,default=5,help="fresh interpreters per mode")
+    parser.add_argument("--max-import-seconds",type=float,default=None,help="fail when the median import is slower")
+    args=parser.parse_args()
+
+    receiver,sender=multiprocessing.Pipe(duplex=False)
+    solr=multiprocessing.Process(target=fakesolr.serve,args=(0,200,sender),daemon=True)
+    solr.start()
+    port=receiver.recv()
+    tmp=tempfile.mkdtemp(prefix="dmtstartup")
+    with open(os.path.join(tmp,"dmtconfig.py"),"w") as config:
+        config.write(CONFIG%{"port":port,"tmp":tmp})
+    env=dict(os.environ)
+    paths=[tmp,os.path.join(BENCHMARKS,os.pardir)]
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"]=os.pathsep.join(paths)
+    try:
+        cold=[probe(env,False) for i in range(args.runs)]
+        warm=[probe(env,True) for i in range(args.runs)]
+    finally:
+        solr.terminate()
+
+    report={"runs":args.runs,
+            "cold":{"import_seconds":summarize(cold,"import_seconds"),"first_request_seconds":summarize(cold,"first_request_seconds")},
+            "warm":{"import_seconds":summarize(warm,"import_seconds"),"warm_seconds":summarize(warm,"warm_seconds"),"first_request_seconds":summarize(warm,"first_request_seconds")},
+            "heavy_modules_at_import":sorted(set(name for run in cold for name in run["heavy_modules"])),
+            "first_request_status":sorted(set(run["first_request_status"] for run in cold+warm))}
+    print(json.dumps(report,indent=2))
+    failed=bool(report["heavy_modules_at_import"]) or report["first_request_status"]!=[200]
+    if args.max_import_seconds is not None and report["cold"]["import_seconds"]["median"]>args.max_import_seconds:
+        failed=True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Local stand-in for Solr used by the load tests. Serves canned responses for the
+learningresources, users and taxonomies cores: select (with paging, cursorMark,
+facet.field and json.facet), real-time get, schema/fields and update.
+
+Run on its own with:
+
+    python benchmarks/fakesolr.py [port] [documents]
+"""
+import json
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import drupal_hash_utility
+
+PASSWORD = "benchmark"
+
+SUBJECTS = ["Aerospace","Agriculture","Biology","Chemistry","Ecology","Geology","Hydrology","Oceanography"]
+KEYWORDS = ["Data management","Data archiving","Metadata","Data sharing","Data citation","Provenance","Data quality","Repositories"]
+TYPES = ["Learning Activity","Lesson","Tutorial","Course","Webinar"]
+ORGS = ["DataONE","NASA","USGS","Oak Ridge National Laboratory","ESIP"]
+LANGUAGES = ["en","es","fr"]
+
+RESOURCE_FIELDS = ["id","_version_","status","title","url","access_cost","submitter_name","submitter_email","author","author_org","contact","contact_org",
+    "abstract.data","subject","keywords","license","usage_rights","citation.data","locator.data","locator.type","publisher","version","created","published",
+    "access_features","language_primary","languages_secondary","ed_framework","target_audience","purpose","completion_time","media_type","type",
+    "contributors.firstname","contributors.lastname","contributors.type","contributor_orgs.name","contributor_orgs.type"]
+
+
+def resource(i):
+    #Deterministic learning resource with every field the formatter touches.
+    subject=SUBJECTS[i%len(SUBJECTS)]
+    keywords=[KEYWORDS[(i+k)%len(KEYWORDS)] for k in range(3)]
+    doc={"id":"resource-%d"%i,"_version_":1000+i,"status":True,
+        "title":"Learning resource %d on %s"%(i,subject.lower()),
+        "url":"https://example.org/resources/%d"%i,
+        "access_cost":float(i%2),
+        "submitter_name":"Submitter %d"%(i%17),
+        "submitter_email":"submitter%d@example.org"%(i%17),
+        "author":["Author %d"%(i%23),"Author %d"%((i+5)%23)],
+        "author_org":[ORGS[i%len(ORGS)]],
+        "contact":"Contact %d"%(i%11),
+        "contact_org":ORGS[(i+1)%len(ORGS)],
+        "abstract.data":"An introduction for researchers to %s in %s. "%(keywords[0].lower(),subject.lower())*8,
+        "subject":[subject],
+        "keywords":keywords,
+        "license":["Creative Commons"],
+        "usage_rights":["Free to use"],
+        "citation.data":["Author %d (2020) Learning resource %d."%(i%23,i)],
+        "locator.data":["10.5281/zenodo.%d"%(239000+i)],
+        "locator.type":["DOI"],
+        "publisher":[ORGS[(i+2)%len(ORGS)]],
+        "version":"1.0",
+        "created":"2020-01-%02dT00:00:00Z"%(1+i%28),
+        "published":"2020-02-%02dT00:00:00Z"%(1+i%28),
+        "access_features":["Transformation"],
+        "language_primary":LANGUAGES[i%len(LANGUAGES)],
+        "languages_secondary":[LANGUAGES[(i+1)%len(LANGUAGES)]],
+        "ed_framework":["FAIR Data Principles"],
+        "target_audience":["Research scientist"],
+        "purpose":["Professional Development"],
+        "completion_time":"1 hour",
+        "media_type":["Moving Image"],
+        "type":[TYPES[i%len(TYPES)]],
+        "contributors.firstname":["Ann","Bo","Cy"][:1+i%3],
+        "contributors.lastname":["Lee","Ng","Roe"][:1+i%3],
+        "contributors.type":["author","editor","reviewer"][:1+i%3],
+        "contributor_orgs.name":[ORGS[i%len(ORGS)]],
+        "contributor_orgs.type":["publisher"]}
+    for name in ["author_org","subject","keywords","license","usage_rights","publisher","access_features","ed_framework","target_audience","type","purpose","media_type","languages_secondary"]:
+        doc["facet_"+name]=doc[name]
+    doc["facet_language_primary"]=[doc["language_primary"]]
+    return doc
+
+
+def schema_fields(names):
+    return [{"name":name,"type":"string" if name.startswith("facet_") or name=="id" else "text_general","multiValued":name not in ("id","_version_"),"required":name=="id","indexed":True,"stored":True} for name in names]
+
+
+class FakeSolr(object):
+    """
+    Canned data of the three cores.
+
+    Parameters:
+
+        documents (int): Number of learning resources in the fake index.
+    """
+    def __init__(self,documents=500):
+        self.resources=[resource(i) for i in range(documents)]
+        self.by_id={doc["id"]:doc for doc in self.resources}
+        self.resource_fields=schema_fields(RESOURCE_FIELDS+sorted(name for name in self.resources[0] if name.startswith("facet_")))
+        hashed=drupal_hash_utility.DrupalHashUtility().encode(PASSWORD)
+        self.users=[{"id":"user-%d"%i,"name":"user%d"%i,"groups":["admin"] if i==0 else ["editor"],"hash":hashed,"_version_":1} for i in range(10)]
+        self.taxonomies=[{"id":"taxonomy-%d"%i,"name":name,"values":values,"_version_":1} for i,(name,values) in enumerate([("Subjects",SUBJECTS),("Keywords",KEYWORDS),("Types",TYPES),("Organizations",ORGS),("Languages",LANGUAGES)])]
+        self.index_version=1
+
+    def core_docs(self,core):
+        return {"learningresources":self.resources,"users":self.users,"taxonomies":self.taxonomies}[core]
+
+    def project(self,doc,fl):
+        if not fl or fl=="*":
+            return dict(doc)
+        names=[name.strip() for name in fl.split(",")]
+        return {name:doc[name] for name in names if name in doc}
+
+    def select(self,core,qs):
+        docs=self.core_docs(core)
+        rows=int(qs.get("rows",["10"])[0])
+        start=int(qs.get("start",["0"])[0])
+        cursor=qs.get("cursorMark",[None])[0]
+        if cursor is not None:
+            start=0 if cursor=="*" else int(cursor)
+        q=qs.get("q",["*:*"])[0]
+        if core=="users" and q.startswith("name:"):
+            docs=[doc for doc in docs if doc["name"]==q[5:].strip('"')]
+        elif core=="users" and q.startswith("id:"):
+            docs=[doc for doc in docs if doc["id"]==q[3:].strip('"')]
+        fl=qs.get("fl",[None])[0]
+        page=[self.project(doc,fl) for doc in docs[start:start+rows]]
+        response={"responseHeader":{"status":0,"QTime":1},"response":{"numFound":len(docs),"start":start,"docs":page}}
+        if cursor is not None:
+            response["nextCursorMark"]=str(min(start+rows,len(docs)))
+        if qs.get("facet",[""])[0] in ("on","true"):
+            response["facet_counts"]={"facet_fields":{field:self.counts(docs,field,flat=True) for field in qs.get("facet.field",[])}}
+        if "json.facet" in qs:
+            facets={"count":len(docs)}
+            for name,spec in json.loads(qs["json.facet"][0]).items():
+                facets[name]={"buckets":[{"val":value,"count":count} for value,count in self.counts(docs,spec["field"])]}
+            response["facets"]=facets
+        if qs.get("hl",[""])[0] in ("on","true"):
+            response["highlighting"]={doc["id"]:{"abstract.data":["An introduction for <em>researchers</em>"]} for doc in page}
+        return response
+
+    def counts(self,docs,field,flat=False):
+        counts={}
+        for doc in docs:
+            for value in doc.get(field,()):
+                counts[value]=counts.get(value,0)+1
+        ordered=sorted(counts.items(),key=lambda item:-item[1])
+        if flat:
+            return [x for pair in ordered for x in pair]
+        return ordered
+
+    def get(self,core,qs):
+        ids=[i for value in qs.get("ids",[]) for i in value.split(",")]+qs.get("id",[])
+        fl=qs.get("fl",[None])[0]
+        docs=[self.project(self.by_id[i],fl) for i in ids if i in self.by_id]
+        return {"response":{"numFound":len(docs),"start":0,"docs":docs}}
+
+    def respond(self,path,qs):
+        parts=path.strip("/").split("/")
+        core,handler="/".join(parts[1:2]),"/".join(parts[2:])
+        if core not in ("learningresources","users","taxonomies"):
+            return 404,{"error":{"msg":"unknown core "+core}}
+        if handler=="select":
+            return 200,self.select(core,qs)
+        if handler=="get":
+            return 200,self.get(core,qs)
+        if handler=="schema/fields":
+            fields={"learningresources":self.resource_fields,"users":schema_fields(["id","_version_","name","groups","hash"]),"taxonomies":schema_fields(["id","_version_","name","values"])}[core]
+            return 200,{"fields":fields}
+        if handler=="replication":
+            return 200,{"indexversion":self.index_version,"generation":self.index_version}
+        if handler.startswith("update"):
+            return 200,{"responseHeader":{"status":0,"QTime":1}}
+        return 404,{"error":{"msg":"unknown handler "+handler}}
+
+
+def handler_class(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version="HTTP/1.1"
+        disable_nagle_algorithm=True
+
+        def log_message(self,*args):
+            pass
+
+        def do_GET(self):
+            url=urlparse(self.path)
+            self.reply(url.path,parse_qs(url.query,keep_blank_values=True))
+
+        def do_POST(self):
+            url=urlparse(self.path)
+            body=self.rfile.read(int(self.headers.get("Content-Length",0)))
+            qs=parse_qs(url.query,keep_blank_values=True)
+            if self.headers.get("Content-Type","").startswith("application/x-www-form-urlencoded"):
+                for key,values in parse_qs(body.decode("utf-8"),keep_blank_values=True).items():
+                    qs.setdefault(key,[]).extend(values)
+            self.reply(url.path,qs)
+
+        def reply(self,path,qs):
+            status,payload=fake.respond(path,qs)
+            body=json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type","application/json")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+
+def serve(port=8983,documents=500,ready=None):
+    """
+    Serves the fake Solr until the process is stopped.
+
+    Parameters:
+
+        port (int): Port to listen on, 0 picks a free port.
+
+        documents (int): Number of learning resources in the fake index.
+
+        ready (Connection): Optional pipe that receives the bound port once listening.
+    """
+    server=ThreadingHTTPServer(("127.0.0.1",port),handler_class(FakeSolr(documents)))
+    server.daemon_threads=True
+    if ready is not None:
+        ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    port=int(sys.argv[1]) if len(sys.argv)>1 else 8983
+    documents=int(sys.argv[2]) if len(sys.argv)>2 else 500
+    print("Fake Solr on http://127.0.0.1:%d/solr/"%port)
+    serve(port,documents)
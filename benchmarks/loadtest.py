@@ -0,0 +1,190 @@
+"""
+Load test of the Flask app against a local fake Solr (benchmarks/fakesolr.py).
+
+Every scenario is run with a number of concurrent clients and reported as JSON with
+throughput and p50/p95/p99 latency, so runs can be stored and compared before deploy.
+No Solr and no dmtconfig.py are needed, a config pointing at the fake Solr is generated.
+
+    python benchmarks/loadtest.py [--requests 200] [--concurrency 8] [--cold]
+        [--scenario search_get ...] [--output run.json] [--compare baseline.json --tolerance 0.25]
+
+--cold clears the result, schema and documentation caches before every request to measure
+the full Solr round trip and formatting. --compare exits with status 1 when a scenario is
+slower than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS)
+import fakesolr
+
+CONFIG = """
+class DevConfig(object):
+    SECRET_KEY = 'loadtest'
+    SOLR_ADDRESS = 'http://127.0.0.1:%(port)d/solr/'
+    SCHEMA_CACHE_STAMP = %(tmp)r+'/schema.stamp'
+    RESULT_CACHE_STAMP = %(tmp)r+'/results.stamp'
+    VOCABULARY_STAMP = %(tmp)r+'/vocabularies.stamp'
+    PDF_CACHE_DIR = %(tmp)r+'/pdf'
+    SOLR_POOL_SIZE = %(concurrency)d
+    LOGIN_RATE = 10**9
+    LOGIN_BURST = 10**9
+    LOGIN_QUEUE = %(concurrency)d
+"""
+
+POST_SEARCH = {"search":[{"group":"and","and":[{"string":"Data management","field":"keywords","type":"match"},{"string":"Aerospace","field":"subject","type":"match"}]}],"limit":20,"facets":True}
+
+#name: (method, path, request arguments, expected status)
+SCENARIOS = {
+    "search_get": ("GET","/api/resources/?keywords=%22Data+management%22&subject=Aerospace&limit=20",{},200),
+    "search_get_fields": ("GET","/api/resources/?keywords=%22Data+management%22&fields=title,url&highlight=true&limit=20",{},200),
+    "search_post_facets": ("POST","/api/resources/",{"json":POST_SEARCH},200),
+    "facets": ("GET","/api/resources/facets",{},200),
+    "batch": ("GET","/api/resources/batch?ids="+",".join("resource-%d"%i for i in range(0,100,5)),{},200),
+    "suggest": ("GET","/api/resources/suggest?field=keywords&q=dat&limit=10",{},200),
+    "vocabularies": ("GET","/api/vocabularies/",{},200),
+    "schema_json": ("GET","/api/schema/resources.json",{},200),
+    "schema_md": ("GET","/api/schema/resources.md",{},200),
+    "schema_html": ("GET","/api/schema/resources.html",{},200),
+    "schema_pdf": ("GET","/api/schema/resources.pdf?wait=true",{},200),
+    "docs_resources": ("GET","/api/resources/documentation.html",{},200),
+    "docs_api": ("GET","/api/",{},200),
+    "login": ("POST","/login/",{"data":{"username":"user1","password":fakesolr.PASSWORD}},302),
+}
+
+
+def percentile(ordered,fraction):
+    #Nearest rank percentile of sorted values.
+    if not ordered:
+        return None
+    rank=max(0,min(len(ordered)-1,int(round(fraction*len(ordered)+0.5))-1))
+    return ordered[rank]
+
+
+def clear_caches(dmt):
+    for name in ["result_cache","facet_cache","schema_cache","schema_artefacts","documentation_cache"]:
+        cache=getattr(dmt,name,None)
+        if cache is not None:
+            cache.clear()
+
+
+def run_scenario(dmt,name,requests,concurrency,cold):
+    """
+    Sends requests copies of a scenario from concurrency clients.
+
+    Returns:
+    dict: Request and error counts, throughput in requests per second and latency percentiles in ms
+    """
+    method,path,kwargs,expected=SCENARIOS[name]
+    local=threading.local()
+    errors=[]
+
+    def send(i):
+        client=getattr(local,"client",None)
+        if client is None:
+            client=local.client=dmt.app.test_client()
+        if cold:
+            clear_caches(dmt)
+        started=time.perf_counter()
+        try:
+            response=client.open(path,method=method,**kwargs)
+            response.get_data()
+            ok=response.status_code==expected
+            if not ok:
+                errors.append("HTTP %d"%response.status_code)
+        except Exception as error:
+            ok=False
+            errors.append(repr(error))
+        return time.perf_counter()-started,ok
+
+    send(-1)
+    started=time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        outcomes=list(pool.map(send,range(requests)))
+    seconds=time.perf_counter()-started
+    latencies=sorted(elapsed*1000 for elapsed,ok in outcomes)
+    failed=sum(1 for elapsed,ok in outcomes if not ok)
+    report={"requests":requests,"errors":failed,"seconds":round(seconds,4),"throughput":round(requests/seconds,2)}
+    for label,fraction in [("p50_ms",0.5),("p95_ms",0.95),("p99_ms",0.99),("max_ms",1.0)]:
+        report[label]=round(percentile(latencies,fraction),3)
+    if failed:
+        report["first_errors"]=errors[:5]
+    return report
+
+
+def compare(current,baseline,tolerance):
+    """
+    Returns the scenarios of current that regressed against baseline.
+    """
+    regressions=[]
+    for name,report in current["scenarios"].items():
+        before=baseline.get("scenarios",{}).get(name)
+        if before is None or report["errors"] or before["errors"]:
+            continue
+        if report["p95_ms"]>before["p95_ms"]*(1+tolerance) or report["throughput"]*(1+tolerance)<before["throughput"]:
+            regressions.append({"scenario":name,"p95_ms":[before["p95_ms"],report["p95_ms"]],"throughput":[before["throughput"],report["throughput"]]})
+    return regressions
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests",type=int,default=200,help="requests per scenario")
+    parser.add_argument("--concurrency",type=int,default=8,help="concurrent clients")
+    parser.add_argument("--documents",type=int,default=500,help="learning resources in the fake index")
+    parser.add_argument("--cold",action="store_true",help="clear the app caches before every request")
+    parser.add_argument("--scenario",action="append",choices=sorted(SCENARIOS),help="scenario to run, may be repeated, defaults to all")
+    parser.add_argument("--output",help="also write the report to this file")
+    parser.add_argument("--compare",help="baseline report to compare against")
+    parser.add_argument("--tolerance",type=float,default=0.25,help="allowed relative slowdown against the baseline")
+    args=parser.parse_args()
+
+    #The fake Solr runs in its own process so it does not compete with the app for the GIL.
+    receiver,sender=multiprocessing.Pipe(duplex=False)
+    solr=multiprocessing.Process(target=fakesolr.serve,args=(0,args.documents,sender),daemon=True)
+    solr.start()
+    port=receiver.recv()
+
+    tmp=tempfile.mkdtemp(prefix="dmtloadtest")
+    with open(os.path.join(tmp,"dmtconfig.py"),"w") as config:
+        config.write(CONFIG%{"port":port,"tmp":tmp,"concurrency":args.concurrency})
+    sys.path.insert(0,tmp)
+    sys.path.insert(1,os.path.join(BENCHMARKS,os.pardir))
+    started=time.perf_counter()
+    import dmtclearinghouse as dmt
+    import_seconds=time.perf_counter()-started
+
+    report={"environment":{"python":platform.python_version(),"platform":platform.platform(),"documents":args.documents,
+                "requests":args.requests,"concurrency":args.concurrency,"cold":args.cold,"import_seconds":round(import_seconds,4)},
+            "scenarios":{}}
+    try:
+        for name in args.scenario or SCENARIOS:
+            report["scenarios"][name]=run_scenario(dmt,name,args.requests,args.concurrency,args.cold)
+            result=report["scenarios"][name]
+            sys.stderr.write("%-20s %8.1f req/s  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  errors %d\n"%(name,result["throughput"],result["p50_ms"],result["p95_ms"],result["p99_ms"],result["errors"]))
+    finally:
+        solr.terminate()
+
+    status=0
+    if args.compare:
+        with open(args.compare) as baseline:
+            report["regressions"]=compare(report,json.load(baseline),args.tolerance)
+        status=1 if report["regressions"] else 0
+    output=json.dumps(report,indent=2)
+    if args.output:
+        with open(args.output,"w") as out:
+            out.write(output+"\n")
+    print(output)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
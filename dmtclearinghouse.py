@@ -1,55 +1,1162 @@
-from flask import Flask, request, redirect, url_for, render_template, make_response
-import pysolr
+from flask import Flask, request, redirect, url_for, render_template, make_response, send_file, g, has_request_context
+import click
 import json
 from flask_login import LoginManager, login_user, logout_user, login_required, UserMixin, current_user
-import drupal_hash_utility
-from docstring_parser import parse
-import requests
-from weasyprint import HTML
-from datetime import date
+#pysolr, requests, drupal_hash_utility and weasyprint are imported on first use, see create_app.
+from datetime import date, datetime, timezone
+from collections import OrderedDict
+from functools import wraps
+from contextlib import contextmanager
+import hashlib
+import re
+import bisect
+import heapq
+import itertools
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.datastructures import MultiDict
+try:
+    import orjson
+except ImportError:
+    orjson = None
 #Create flask app
 app = Flask(__name__)
 
-#Pull config info from file
-app.config.from_object('dmtconfig.DevConfig')
+#Pull config info from file, DMT_CONFIG selects another config object.
+app.config.from_object(os.environ.get("DMT_CONFIG",'dmtconfig.DevConfig'))
 resources_facets=["facet_author_org","facet_subject","facet_keywords","facet_license","facet_usage_rights","facet_publisher","facet_access_features","facet_language_primary","facet_languages_secondary","facet_ed_framework","facet_target_audience","facet_type","facet_purpose","facet_media_type"]
-#Create a pysolr object for accessing the "learningresources" and "users" index
-resources = pysolr.Solr(app.config["SOLR_ADDRESS"]+"learningresources/", timeout=10)
-users = pysolr.Solr(app.config["SOLR_ADDRESS"]+"users/", timeout=10)
-taxonomies = pysolr.Solr(app.config["SOLR_ADDRESS"]+"taxonomies/", timeout=10)
 #flask_login implementation. 
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-#Drupal hash utility as we will continue to use Drupal hashes.
-drash = drupal_hash_utility.DrupalHashUtility()
+#Time used as Last-Modified for content that only changes between deploys.
+app_started = datetime.now(timezone.utc).replace(microsecond=0)
 
 
 ##############################
 #Shared Functions and classes#
 ##############################
-def append_searchstring(searchstring,request,name):
+class TTLCache(object):
     """ 
-    Appends searchstring for most text searches.
-    
+    Small thread safe LRU cache with optional expiry of entries.
+
     Parameters: 
 
-        searcstring (str): Existing search string.
+        maxsize (int): Maximum number of entries kept before the least recently used is evicted.
 
-        request (request):  The full request made to a route.
-        
-        name (str): The name of the parameter we wish to append to the string.
+        ttl (float): Seconds an entry stays valid, None keeps entries until evicted.
+
+        maxbytes (int): Maximum total size of the kept values, None for no limit.
+
+        sizeof (function): Returns the size in bytes of a value, required with maxbytes.
+    """
+    def __init__(self,maxsize=256,ttl=None,maxbytes=None,sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self,entry):
+        if self.sizeof is None:
+            return 0
+        return self.sizeof(entry[0])
+
+    def get(self,key,default=None):
+        with self._lock:
+            entry=self._data.get(key)
+            if entry is None:
+                return default
+            value,expires=entry
+            if expires is not None and expires<time.monotonic():
+                self.bytes-=self._size(self._data.pop(key))
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self,key,value,ttl=None):
+        #ttl overrides the expiry of this entry.
+        if ttl is None:
+            ttl=self.ttl
+        expires=None
+        if ttl is not None:
+            expires=time.monotonic()+ttl
+        entry=(value,expires)
+        size=self._size(entry)
+        if self.maxbytes is not None and size>self.maxbytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.bytes-=self._size(self._data.pop(key))
+            self._data[key]=entry
+            self.bytes+=size
+            while len(self._data)>self.maxsize or (self.maxbytes is not None and self.bytes>self.maxbytes):
+                self.bytes-=self._size(self._data.popitem(last=False)[1])
+
+    def pop(self,key,default=None):
+        with self._lock:
+            entry=self._data.pop(key,None)
+            if entry is None:
+                return default
+            self.bytes-=self._size(entry)
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes=0
+
+    def __len__(self):
+        return len(self._data)
+
+class InvalidationStamp(object):
+    """ 
+    File whose modification time is shared by worker processes to invalidate in process caches.
+
+    Parameters: 
+
+        path (str): Path of the stamp file.
+
+        caches (list): Caches cleared when the stamp changes.
+    """
+    def __init__(self,path,caches):
+        self.path = path
+        self.caches = caches
+        self.mtime = None
+
+    def check(self):
+        """ 
+        Clears the caches when another process touched the stamp since the last check.
+        """
+        try:
+            mtime=os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime!=self.mtime:
+            self.mtime=mtime
+            for cache in self.caches:
+                cache.clear()
+
+    def touch(self):
+        """ 
+        Invalidates the caches in every process.
+        """
+        with open(self.path,'a'):
+            os.utime(self.path)
+        self.check()
+        for cache in self.caches:
+            cache.clear()
+
+#Solr schemas keyed by core and rendered schema documents keyed by (collection, returntype, date).
+schema_cache = TTLCache(maxsize=16,ttl=app.config.get("SCHEMA_CACHE_TTL",3600))
+schema_artefacts = TTLCache(maxsize=64,ttl=app.config.get("SCHEMA_CACHE_TTL",3600))
+#Touching this file invalidates the schema caches of every worker process.
+schema_stamp = InvalidationStamp(app.config.get("SCHEMA_CACHE_STAMP",os.path.join(tempfile.gettempdir(),"dmtclearinghouse-schema.stamp")),[schema_cache,schema_artefacts])
+
+class ArtefactStore(object):
+    """ 
+    Directory of rendered artefacts eg. schema PDFs, shared by the worker processes and kept
+    across restarts. Artefacts are rendered by background jobs on executor, named after their
+    file. A job holds name.part, created exclusively, as a lock so only one process renders a
+    name, writes the render to a temporary file of its own and renames that file to name. A failed job leaves name.failed, which is reported instead of
+    rendering again until backoff seconds have passed.
+
+    Parameters: 
+
+        directory (str): Directory holding the artefacts.
+
+        executor (Executor): Pool running the render jobs.
+
+        timeout (float): Seconds after which an unfinished job of any process is taken over.
+
+        backoff (float): Seconds a failed render is reported before it is tried again.
+    """
+    name_pattern = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+
+    def __init__(self,directory,executor,timeout=120,backoff=300):
+        self.directory = directory
+        self.executor = executor
+        self.timeout = timeout
+        self.backoff = backoff
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def path(self,name):
+        if not self.name_pattern.match(name):
+            raise ValueError("invalid artefact name "+name)
+        return os.path.join(self.directory,name)
+
+    def claimed(self,name):
+        #True while another job, possibly in another process, is writing name.
+        try:
+            return time.time()-os.stat(self.path(name)+".part").st_mtime<self.timeout
+        except OSError:
+            return False
+
+    def error(self,name):
+        """ 
+        Returns the error of a render that failed less than backoff seconds ago, None otherwise.
+        """
+        try:
+            with open(self.path(name)+".failed") as failed:
+                if time.time()-os.fstat(failed.fileno()).st_mtime<self.backoff:
+                    return failed.read()
+        except OSError:
+            pass
+        return None
+
+    def status(self,name):
+        """ 
+        Returns done, running or failed, None for an unknown job.
+        """
+        if os.path.exists(self.path(name)):
+            return "done"
+        with self._lock:
+            if name in self.jobs:
+                return "running"
+        if self.claimed(name):
+            return "running"
+        if self.error(name) is not None:
+            return "failed"
+        return None
+
+    def submit(self,name,render,prune=None):
+        """ 
+        Starts a job rendering name unless it exists, is being rendered or recently failed.
+
+        Parameters: 
+
+            name (str): File name of the artefact.
+
+            render (function): Returns the artefact as bytes, run on the executor.
+
+            prune (str): Prefix of the outdated artefacts removed once name is written.
+
+        Returns: 
+        str: Status of the job
+        """
+        status=self.status(name)
+        if status is not None:
+            return status
+        with self._lock:
+            if name not in self.jobs:
+                self.jobs[name]=self.executor.submit(self.run,name,render,prune)
+        return "running"
+
+    def claim(self,name):
+        #Creates the name.part lock exclusively, taking over the lock of a job that stopped. False when another job holds it.
+        part=self.path(name)+".part"
+        flags=os.O_CREAT|os.O_EXCL|os.O_WRONLY
+        try:
+            os.close(os.open(part,flags,0o644))
+            return True
+        except FileExistsError:
+            if self.claimed(name):
+                return False
+        try:
+            os.unlink(part)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(part,flags,0o644))
+            return True
+        except FileExistsError:
+            return False
+
+    def run(self,name,render,prune):
+        path=self.path(name)
+        locked=False
+        temp=None
+        try:
+            os.makedirs(self.directory,exist_ok=True)
+            locked=self.claim(name)
+            if not locked:
+                return
+            #Every job renders to its own file, so a job only ever publishes what it wrote.
+            fd,temp=tempfile.mkstemp(prefix="."+name+".",suffix=".tmp",dir=self.directory)
+            with os.fdopen(fd,"wb") as out:
+                out.write(render())
+            os.replace(temp,path)
+            temp=None
+        except Exception as error:
+            app.logger.exception("Rendering %s failed.",name)
+            try:
+                with open(path+".failed","w") as failed:
+                    failed.write(str(error))
+            except OSError:
+                pass
+            return
+        finally:
+            for leftover in [temp,path+".part" if locked else None]:
+                if leftover is not None:
+                    try:
+                        os.unlink(leftover)
+                    except OSError:
+                        pass
+            with self._lock:
+                self.jobs.pop(name,None)
+        if prune:
+            for other in os.listdir(self.directory):
+                if other.startswith(prune) and other!=name and not other.endswith(".part"):
+                    try:
+                        os.unlink(os.path.join(self.directory,other))
+                    except OSError:
+                        pass
+
+    def wait(self,name,timeout):
+        """ 
+        Waits up to timeout seconds for a job, returns True once the artefact exists.
+        """
+        deadline=time.monotonic()+timeout
+        while time.monotonic()<deadline:
+            status=self.status(name)
+            if status!="running":
+                return status=="done"
+            with self._lock:
+                future=self.jobs.get(name)
+            if future is not None:
+                try:
+                    future.result(timeout=max(0,deadline-time.monotonic()))
+                except Exception:
+                    pass
+            else:
+                time.sleep(0.2)
+        return self.status(name)=="done"
+
+#Schema PDFs are rendered by background jobs on a small pool and kept on disk keyed by collection and schema hash.
+pdf_executor = ThreadPoolExecutor(max_workers=app.config.get("PDF_WORKERS",1))
+pdf_store = ArtefactStore(app.config.get("PDF_CACHE_DIR",os.path.join(tempfile.gettempdir(),"dmtclearinghouse-pdf")),pdf_executor,timeout=app.config.get("PDF_RENDER_TIMEOUT",120),backoff=app.config.get("PDF_FAILURE_BACKOFF",300))
+
+class Metrics(object):
+    """ 
+    Thread safe counters and histograms of this process, exposed on /metrics in Prometheus text format.
+
+    Parameters: 
+
+        buckets (tuple): Upper bounds in seconds of the histogram buckets.
+    """
+    def __init__(self,buckets=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def describe(self,name,kind,help):
+        self.help[name]=(kind,help)
+
+    def inc(self,name,labels,value=1):
+        key=(name,tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key]=self.counters.get(key,0)+value
+
+    def observe(self,name,labels,seconds):
+        key=(name,tuple(sorted(labels.items())))
+        index=bisect.bisect_left(self.buckets,seconds)
+        with self._lock:
+            histogram=self.histograms.get(key)
+            if histogram is None:
+                histogram=self.histograms[key]=[[0]*(len(self.buckets)+1),0.0,0]
+            histogram[0][index]+=1
+            histogram[1]+=seconds
+            histogram[2]+=1
+
+    def render(self):
+        """ 
+        Returns the Prometheus text lines of every metric.
+        """
+        with self._lock:
+            counters=sorted(self.counters.items())
+            histograms=sorted((key,[list(value[0]),value[1],value[2]]) for key,value in self.histograms.items())
+        lines=[]
+        described=set()
+        def header(name,kind):
+            if name not in described:
+                described.add(name)
+                lines.append("# HELP "+name+" "+self.help.get(name,(kind,name))[1]+".")
+                lines.append("# TYPE "+name+" "+kind)
+        for (name,labels),value in counters:
+            header(name,"counter")
+            lines.append(name+format_labels(labels)+" "+str(value))
+        for (name,labels),(counts,total,count) in histograms:
+            header(name,"histogram")
+            for bound,cumulative in zip(self.buckets+("+Inf",),itertools.accumulate(counts)):
+                lines.append(name+"_bucket"+format_labels(labels+(("le",str(bound)),))+" "+str(cumulative))
+            lines.append(name+"_sum"+format_labels(labels)+" "+repr(total))
+            lines.append(name+"_count"+format_labels(labels)+" "+str(count))
+        return lines
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{"+",".join(k+'="'+str(v).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")+'"' for k,v in labels)+"}"
+
+request_metrics = Metrics()
+request_metrics.describe("dmt_requests_total","counter","Requests answered per route, method and status")
+request_metrics.describe("dmt_request_seconds","histogram","Seconds spent answering requests per route and method")
+request_metrics.describe("dmt_span_seconds","histogram","Seconds spent in the query build, formatting, template and PDF render steps of requests")
+request_metrics.describe("dmt_solr_request_seconds","histogram","Seconds of single Solr requests per core, retries included as separate requests")
+request_metrics.describe("dmt_warmed_searches_total","counter","Popular searches precomputed into the result cache by the warmer, per outcome")
+
+def record_span(name,labels,seconds):
+    """ 
+    Adds a timed step to the timings of the current request, if any.
+    """
+    if has_request_context():
+        spans=g.get('spans')
+        if spans is not None:
+            spans.append((name,labels,seconds))
+
+@contextmanager
+def span(name,**labels):
+    """ 
+    Times a step of a request eg. with span("format"): ...
+    The duration is observed in dmt_span_seconds and kept with the timings of the request
+    for the Server-Timing header and the slow request log.
+    """
+    started=time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed=time.perf_counter()-started
+        labels['span']=name
+        request_metrics.observe("dmt_span_seconds",labels,elapsed)
+        record_span(name,labels,elapsed)
+
+class SolrPool(object):
+    """ 
+    Client layer shared by all Solr cores and the schema API.
+    One pooled keep-alive session is used for every request, with per operation timeouts,
+    bounded retries with backoff on transient errors and per core counters.
+
+    Parameters: 
+
+        address (str): Base address of Solr eg. http://localhost:8983/solr/
+
+        pool_size (int): Maximum number of kept alive connections, usually the WSGI thread count.
+
+        timeouts (dict): Seconds allowed per operation eg. {"search":10}
+
+        retries (int): Number of retries after a transient error.
+
+        backoff (float): Seconds waited before the first retry, doubled for each further retry.
+    """
+    transient_errors = ("Connection to server","Failed to connect","Solr responded with an error (HTTP 502)","Solr responded with an error (HTTP 503)","Solr responded with an error (HTTP 504)")
+
+    def __init__(self,address,pool_size=5,timeouts=None,retries=2,backoff=0.2):
+        self.address = address
+        self.timeouts = {"search":10,"get":5,"schema":5,"update":30}
+        self.timeouts.update(timeouts or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.stats = {}
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """ 
+        The pooled requests session, created on first use so importing the app opens no connections.
+        """
+        session=self._session
+        if session is None:
+            import requests
+            import requests.adapters
+            with self._lock:
+                if self._session is None:
+                    session=requests.Session()
+                    adapter=requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session=session
+                session=self._session
+        return session
+
+    def close(self):
+        """ 
+        Closes the pooled connections, a new session is created on the next request.
+        Used before forking workers so no connection is shared between processes.
+        """
+        with self._lock:
+            session,self._session=self._session,None
+            self._clients={}
+        if session is not None:
+            session.close()
+
+    def core(self,name):
+        return SolrCore(self,name)
+
+    def client(self,core,operation):
+        """ 
+        Returns the pysolr client of a core for an operation, sharing the pooled session.
+        """
+        key=(core,operation)
+        client=self._clients.get(key)
+        if client is None:
+            import pysolr
+            client=pysolr.Solr(self.address+core+"/", timeout=self.timeouts[operation], session=self.session)
+            self._clients[key]=client
+        return client
+
+    def is_transient(self,error):
+        import pysolr
+        import requests
+        if isinstance(error,(requests.exceptions.ConnectionError,requests.exceptions.Timeout)):
+            return True
+        if isinstance(error,requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code in (502,503,504)
+        return isinstance(error,pysolr.SolrError) and str(error).startswith(self.transient_errors)
+
+    def record(self,core,started,error=False,retry=False):
+        elapsed=time.perf_counter()-started
+        request_metrics.observe("dmt_solr_request_seconds",{"core":core},elapsed)
+        record_span("solr",{"core":core},elapsed)
+        with self._lock:
+            corestats=self.stats.setdefault(core,{"requests":0,"errors":0,"retries":0,"seconds":0.0})
+            corestats["requests"]+=1
+            corestats["seconds"]+=elapsed
+            corestats["errors"]+=int(error)
+            corestats["retries"]+=int(retry)
+
+    def call(self,core,function,*args,**kwargs):
+        """ 
+        Calls function with retries on transient errors, recording latency and errors for core.
+        """
+        attempt=0
+        while True:
+            started=time.perf_counter()
+            try:
+                result=function(*args,**kwargs)
+            except Exception as error:
+                retry=attempt<self.retries and self.is_transient(error)
+                self.record(core,started,error=True,retry=retry)
+                if not retry:
+                    raise
+                time.sleep(self.backoff*(2**attempt))
+                attempt+=1
+                continue
+            self.record(core,started)
+            return result
+
+    def get_json(self,core,path,params=None,operation="get"):
+        """ 
+        Performs a GET against a core handler that is not covered by pysolr eg. schema/fields.
+        """
+        def send():
+            r=self.session.get(self.address+core+"/"+path, params=params, timeout=self.timeouts[operation])
+            r.raise_for_status()
+            return r.json()
+        return self.call(core,send)
+
+class SolrCore(object):
+    """ 
+    A single Solr core accessed through a SolrPool.
+    """
+    def __init__(self,pool,name):
+        self.pool = pool
+        self.name = name
+
+    def search(self,q,**kwargs):
+        if has_request_context() and g.get('spans') is not None:
+            g.setdefault('solr_queries',[]).append({"core":self.name,"q":q,"fq":kwargs.get("fq")})
+        return self.pool.call(self.name,self.pool.client(self.name,"search").search,q,**kwargs)
+
+    def add(self,docs,**kwargs):
+        return self.pool.call(self.name,self.pool.client(self.name,"update").add,docs,**kwargs)
+
+    def get_json(self,path,params=None,operation="get"):
+        return self.pool.get_json(self.name,path,params,operation)
+
+#Shared Solr client layer and the "learningresources", "users" and "taxonomies" cores.
+solr = SolrPool(app.config["SOLR_ADDRESS"],pool_size=app.config.get("SOLR_POOL_SIZE",5),timeouts=app.config.get("SOLR_TIMEOUTS"),retries=app.config.get("SOLR_RETRIES",2),backoff=app.config.get("SOLR_RETRY_BACKOFF",0.2))
+resources = solr.core("learningresources")
+users = solr.core("users")
+taxonomies = solr.core("taxonomies")
+
+class IndexVersions(object):
+    """ 
+    Index versions of Solr cores read from the replication handler, polled at most every
+    interval seconds per core instead of per request. A changed version runs the callbacks
+    registered for the core, which clear the caches of this process built from the old index.
+
+    Parameters: 
+
+        pool (SolrPool): Client layer used for the polls.
+
+        interval (float): Seconds between polls of a core, None disables polling.
+    """
+    def __init__(self,pool,interval=30):
+        self.pool = pool
+        self.interval = interval
+        self.versions = {}
+        self.known = {}
+        self.checked = {}
+        self.listeners = {}
+        self._lock = threading.Lock()
+
+    def on_change(self,core,callback):
+        self.listeners.setdefault(core,[]).append(callback)
+
+    def due(self,core):
+        if self.interval is None:
+            return False
+        checked=self.checked.get(core)
+        return checked is None or time.monotonic()-checked>=self.interval
+
+    def poll(self,core):
+        """ 
+        Reads the index version of core unless another thread just did.
+        """
+        with self._lock:
+            if not self.due(core):
+                return
+            self.checked[core]=time.monotonic()
+        try:
+            status=self.pool.get_json(core,"replication",{"command":"indexversion","wt":"json"})
+            version=str(status['indexversion'])+"."+str(status['generation'])
+        except Exception:
+            app.logger.warning("Index version of %s could not be read, ETags fall back to content hashes.",core)
+            version=None
+        self.versions[core]=version
+        if version is None:
+            return
+        #Changes are detected against the last version read, so a failed poll does not hide a commit.
+        previous=self.known.get(core)
+        self.known[core]=version
+        if previous is not None and version!=previous:
+            for callback in self.listeners.get(core,[]):
+                callback()
+
+    def current(self,core):
+        """ 
+        Returns the index version of core, None when it is unknown.
+        """
+        if self.due(core):
+            self.poll(core)
+        return self.versions.get(core)
+
+#Index versions polled every INDEX_VERSION_POLL seconds, used for ETags and to drop caches after commits.
+index_versions = IndexVersions(solr,interval=app.config.get("INDEX_VERSION_POLL",30))
+
+class VocabularyIndex(object):
+    """ 
+    In memory copy of the taxonomies core, answering vocabulary listings and lookups by
+    name, id and value without Solr round-trips. Reloaded every refresh seconds or when cleared.
+
+    Parameters: 
+
+        core (SolrCore): The taxonomies core.
+
+        refresh (float): Seconds before the vocabularies are reloaded.
+    """
+    def __init__(self,core,refresh=600):
+        self.core = core
+        self.refresh = refresh
+        self.loaded = None
+        self.vocabularies = []
+        self.by_id = {}
+        self.prefixes = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(re.findall(r"\w+",str(text).lower()))
+
+    def load(self):
+        """ 
+        Fetches every vocabulary from Solr and swaps in the new index.
+        """
+        vocabularies=[]
+        cursor="*"
+        while True:
+            results=self.core.search("*:*", sort="id asc", rows=500, cursorMark=cursor)
+            for result in results.docs:
+                result.pop('_version_', None)
+                values=result.get('values') or []
+                if not isinstance(values,list):
+                    values=[values]
+                vocabularies.append({"doc":result,
+                                     "name":self.normalize(result.get('name','')),
+                                     "values":[self.normalize(value) for value in values],
+                                     "tokens":set(" ".join(self.normalize(value) for value in values).split())})
+            if results.nextCursorMark is None or results.nextCursorMark==cursor:
+                break
+            cursor=results.nextCursorMark
+        prefixes=[]
+        for vocabulary in vocabularies:
+            for value in vocabulary['doc'].get('values') or []:
+                prefixes.append((str(value).lower(),str(value),vocabulary['doc']['id'],vocabulary['doc'].get('name')))
+        prefixes.sort()
+        self.vocabularies=vocabularies
+        self.by_id={vocabulary['doc']['id']:vocabulary for vocabulary in vocabularies}
+        self.prefixes=prefixes
+        self.loaded=time.monotonic()
+
+    def current(self):
+        """ 
+        Returns the index, reloading it first when it is stale.
+        A failed reload keeps serving the previous copy and is retried after refresh seconds.
+        """
+        if self.loaded is None or time.monotonic()-self.loaded>self.refresh:
+            with self._lock:
+                if self.loaded is None or time.monotonic()-self.loaded>self.refresh:
+                    try:
+                        self.load()
+                    except Exception:
+                        if not self.vocabularies:
+                            raise
+                        app.logger.exception("Reloading vocabularies failed, serving the previous copy.")
+                        self.loaded=time.monotonic()
+        return self
+
+    def clear(self):
+        self.loaded=None
+
+    def matches(self,normalized,tokens,query):
+        """ 
+        Matches a query like Solr does on a text field: a quoted query is a phrase,
+        otherwise every word has to be present.
+        """
+        query=str(query).strip()
+        if len(query)>1 and query.startswith('"') and query.endswith('"'):
+            phrase=" "+self.normalize(query[1:-1])+" "
+            return any(phrase in " "+value+" " for value in normalized)
+        return set(self.normalize(query).split())<=tokens
+
+    def names(self):
+        return [vocabulary['doc']['name'] for vocabulary in self.vocabularies if 'name' in vocabulary['doc']]
+
+    def search(self,name=None,values=None,id=None):
+        """ 
+        Returns the vocabularies matching all given arguments.
+        """
+        found=[]
+        candidates=self.vocabularies
+        if id is not None:
+            candidates=[self.by_id[id]] if id in self.by_id else []
+        for vocabulary in candidates:
+            if name is not None and not self.matches([vocabulary['name']],set(vocabulary['name'].split()),name):
+                continue
+            if values is not None and not self.matches(vocabulary['values'],vocabulary['tokens'],values):
+                continue
+            found.append(vocabulary['doc'])
+        return found
+
+    def complete(self,prefix,limit=10,ids=None):
+        """ 
+        Returns up to limit values starting with prefix, optionally only from the vocabularies in ids.
+        """
+        prefix=str(prefix).lower()
+        found=[]
+        prefixes=self.prefixes
+        for lowered,value,vocabulary_id,name in itertools.islice(prefixes,bisect.bisect_left(prefixes,(prefix,)),None):
+            if not lowered.startswith(prefix) or len(found)>=limit:
+                break
+            if ids is None or vocabulary_id in ids:
+                found.append({"value":value,"id":vocabulary_id,"vocabulary":name})
+        return found
+
+#Vocabularies served from memory, reloaded every VOCABULARY_REFRESH seconds or when the stamp is touched.
+vocabulary_index = VocabularyIndex(taxonomies,refresh=app.config.get("VOCABULARY_REFRESH",600))
+vocabularies_stamp = InvalidationStamp(app.config.get("VOCABULARY_STAMP",os.path.join(tempfile.gettempdir(),"dmtclearinghouse-vocabularies.stamp")),[vocabulary_index])
+index_versions.on_change("taxonomies",vocabulary_index.clear)
+
+class SuggestIndex(object):
+    """ 
+    In memory completion index of the facet terms of published learning resources, built
+    from a single JSON facet request. Terms are kept per field sorted by their lower case
+    text, once from the start of the value and once from every following word, so "man"
+    completes "Data management". The top suggestions of prefixes up to precompute characters
+    are computed at load, longer prefixes select a narrow range of the sorted terms. Once built,
+    the whole index is rebuilt in a background thread when stale or cleared.
+
+    Parameters: 
+
+        core (SolrCore): The learningresources core.
+
+        facets (list): Facet fields to index.
+
+        refresh (float): Seconds before the index is rebuilt.
+
+        precompute (int): Longest prefix whose suggestions are computed at load.
+
+        topk (int): Largest number of suggestions per request.
+    """
+    def __init__(self,core,facets,refresh=600,precompute=2,topk=20):
+        self.core = core
+        self.facets = facets
+        self.refresh = refresh
+        self.precompute = precompute
+        self.topk = topk
+        self.loaded = None
+        self.rebuilding = False
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ 
+        Fetches the terms and counts of every facet field and swaps in the new index.
+        """
+        jsonfacet={rf:{"type":"terms","field":rf,"mincount":1,"limit":-1} for rf in self.facets}
+        results=self.core.search("*:*", fq="status:true", rows=0, **{"json.facet":json.dumps(jsonfacet)})
+        facetcounts=results.raw_response.get("facets",{})
+        fields={}
+        for rf in self.facets:
+            entries=[]
+            for bucket in facetcounts.get(rf,{}).get("buckets",[]):
+                value=str(bucket['val'])
+                lowered=value.lower()
+                #Entries sort by text and then by descending count.
+                for start in [0]+[match.end() for match in re.finditer(r"\W+",lowered) if 0<match.end()<len(lowered)]:
+                    entries.append((lowered[start:],-bucket['count'],value))
+            entries.sort()
+            top={}
+            for key,negative,value in entries:
+                for length in range(1,min(self.precompute,len(key))+1):
+                    top.setdefault(key[:length],set()).add((negative,value))
+            for prefix,candidates in top.items():
+                top[prefix]=sorted(candidates)[:self.topk]
+            fields[rf.replace('facet_','')]=([entry[0] for entry in entries],entries,top)
+        self.fields=fields
+        self.loaded=time.monotonic()
+
+    def stale(self):
+        return self.loaded is None or time.monotonic()-self.loaded>self.refresh
+
+    def current(self):
+        """ 
+        Returns the index. Only the first build runs on the calling thread, a stale index is
+        rebuilt in a background thread while the previous copy is served.
+        """
+        if not self.fields:
+            with self._lock:
+                if not self.fields:
+                    self.load()
+            return self
+        if self.stale() and not self.rebuilding:
+            with self._lock:
+                if self.stale() and not self.rebuilding:
+                    self.rebuilding=True
+                    threading.Thread(target=self.rebuild,name="dmt-suggest-rebuild",daemon=True).start()
+        return self
+
+    def rebuild(self):
+        #A failed rebuild keeps serving the previous copy and is retried after refresh seconds.
+        try:
+            self.load()
+        except Exception:
+            app.logger.exception("Rebuilding suggestions failed, serving the previous copy.")
+            self.loaded=time.monotonic()
+        finally:
+            self.rebuilding=False
+
+    def clear(self):
+        self.loaded=None
+
+    def complete(self,field,prefix,limit=10):
+        """ 
+        Returns up to limit values of field containing a word starting with prefix, by document count.
+        """
+        keys,entries,top=self.fields.get(field,([],[],{}))
+        prefix=prefix.lower()
+        limit=min(limit,self.topk)
+        if not prefix:
+            return []
+        if len(prefix)<=self.precompute:
+            candidates=top.get(prefix,[])
+        else:
+            candidates=sorted(set((negative,value) for key,negative,value in entries[bisect.bisect_left(keys,prefix):bisect.bisect_left(keys,prefix+"\uffff")]))
+        return [{"value":value,"count":-negative} for negative,value in candidates[:limit]]
+
+#Completions of facet terms, rebuilt every SUGGEST_REFRESH seconds and when the learningresources index changes.
+suggest_index = SuggestIndex(resources,resources_facets,refresh=app.config.get("SUGGEST_REFRESH",600),precompute=app.config.get("SUGGEST_PRECOMPUTE",2))
+index_versions.on_change("learningresources",suggest_index.clear)
+
+#Compiled structured searches keyed by a hash of the normalized search tree.
+compiled_searches = TTLCache(maxsize=1024)
+
+#Formatted search responses keyed by the normalized search, bounded by RESULT_CACHE_BYTES.
+result_cache = TTLCache(maxsize=app.config.get("RESULT_CACHE_SIZE",4096),ttl=app.config.get("RESULT_CACHE_TTL",300),maxbytes=app.config.get("RESULT_CACHE_BYTES",64*1024*1024),sizeof=lambda value: len(value[0]))
+#Facet counts of all published resources, kept until the next purge.
+facet_cache = TTLCache(maxsize=256)
+
+class QueryStats(object):
+    """ 
+    Request counts of normalized searches, keyed like the result cache. When maxsize searches
+    are tracked the counts are halved and searches left at zero dropped, so recent traffic
+    outweighs old traffic and rare searches do not grow the table.
+
+    Parameters: 
+
+        maxsize (int): Maximum number of searches tracked.
+    """
+    def __init__(self,maxsize=1000):
+        self.maxsize = maxsize
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self,key):
+        with self._lock:
+            if key not in self.counts:
+                while len(self.counts)>=self.maxsize:
+                    self.decay()
+            self.counts[key]=self.counts.get(key,0)+1
+
+    def decay(self):
+        #Called with the lock held.
+        for key,count in list(self.counts.items()):
+            if count<2:
+                del self.counts[key]
+            else:
+                self.counts[key]=count//2
+
+    def top(self,n):
+        """ 
+        Returns the n most frequent searches as (key, count), most frequent first.
+        """
+        with self._lock:
+            return heapq.nlargest(n,self.counts.items(),key=lambda item: item[1])
+
+    def clear(self):
+        with self._lock:
+            self.counts.clear()
+
+class SearchWarmer(object):
+    """ 
+    Precomputes the first page and facets of the most frequent searches into the result cache,
+    so the hottest searches are served from memory without a Solr request. A run starts in the
+    background on the first search after the results were cleared, by a new learningresources
+    index version or a purge, and every interval seconds so warmed entries are refreshed before
+    they expire.
+
+    Parameters: 
+
+        stats (QueryStats): Frequencies of the searches.
+
+        cache (TTLCache): Cache the responses are stored in.
+
+        top (int): Number of searches precomputed per run, 0 disables warming.
+
+        interval (float): Seconds between runs, None only warms after the results were cleared.
+    """
+    def __init__(self,stats,cache,top=20,interval=240):
+        self.stats = stats
+        self.cache = cache
+        self.top = top
+        self.interval = interval
+        self.warmed = time.monotonic()
+        self.running = False
+        self._lock = threading.Lock()
+
+    def due(self):
+        if not self.top or self.running:
+            return False
+        if self.warmed is None:
+            return True
+        return self.interval is not None and time.monotonic()-self.warmed>=self.interval
+
+    def check(self):
+        """ 
+        Starts a background run when one is due and none is running.
+        """
+        if not self.due():
+            return
+        with self._lock:
+            if not self.due():
+                return
+            self.running=True
+            self.warmed=time.monotonic()
+        threading.Thread(target=self.run,name="dmt-search-warmer",daemon=True).start()
+
+    def clear(self):
+        #Called with the caches it fills, the next search starts a run.
+        self.warmed=None
+
+    def run(self):
+        try:
+            for key,count in self.stats.top(self.top):
+                try:
+                    self.warm(key)
+                    status="ok"
+                except Exception:
+                    app.logger.warning("Warming the search %s failed.",key,exc_info=True)
+                    status="error"
+                request_metrics.inc("dmt_warmed_searches_total",{"status":status})
+        finally:
+            self.running=False
+
+    def warm(self,key):
+        """ 
+        Runs the search of a result cache key outside of any request and caches its response.
+        """
+        method,host_url,query=key
+        if method=="POST":
+            content=json.loads(query)
+            with app.test_request_context("/api/resources/",base_url=host_url,method="POST",json=content):
+                cache_search(key,lambda: search_resources_post(content),self.cache)
+        else:
+            with app.test_request_context("/api/resources/",base_url=host_url,query_string=MultiDict(query)):
+                cache_search(key,lambda: search_resources_get(request),self.cache)
+
+#Frequencies of first page searches on /api/resources/, the WARM_SEARCHES most frequent are kept in the result cache.
+search_stats = QueryStats(maxsize=app.config.get("SEARCH_STATS_SIZE",1000))
+search_warmer = SearchWarmer(search_stats,result_cache,top=app.config.get("WARM_SEARCHES",20),interval=app.config.get("WARM_INTERVAL",240))
+
+#Touching this file, eg. after a commit to learningresources, purges the result caches of every worker process.
+results_stamp = InvalidationStamp(app.config.get("RESULT_CACHE_STAMP",os.path.join(tempfile.gettempdir(),"dmtclearinghouse-results.stamp")),[result_cache,facet_cache,suggest_index,search_warmer])
+index_versions.on_change("learningresources",result_cache.clear)
+index_versions.on_change("learningresources",facet_cache.clear)
+index_versions.on_change("learningresources",search_warmer.clear)
+
+#Rendered documentation pages keyed by (route, document, host_url, jsonexample).
+documentation_cache = TTLCache(maxsize=app.config.get("DOCUMENTATION_CACHE_SIZE",256))
+
+class RedisCache(object):
+    """ 
+    Cache shared between worker processes with the same interface as TTLCache.
+    Values must be JSON serializable. Requires the redis package.
+
+    Parameters: 
+
+        url (str): Redis URL eg. redis://localhost:6379/0
+
+        prefix (str): Prefix of the keys written by this cache.
+
+        ttl (float): Seconds an entry stays valid.
+    """
+    def __init__(self,url,prefix,ttl=None):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self,key,default=None):
+        value=self.client.get(self.prefix+str(key))
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self,key,value):
+        ttl=None
+        if self.ttl is not None:
+            ttl=max(1,int(self.ttl))
+        self.client.set(self.prefix+str(key),json.dumps(value),ex=ttl)
+
+    def pop(self,key,default=None):
+        value=self.get(key,default)
+        self.client.delete(self.prefix+str(key))
+        return value
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix+"*"):
+            self.client.delete(key)
+
+class SearchQueryError(ValueError):
+    """ 
+    Raised when a structured search can not be compiled into a Solr query.
+    """
+
+#Lucene query syntax characters escaped in search values. Wildcards are kept for simple searches.
+solr_special_characters = re.compile(r'([+\-&|!(){}\[\]^"~:\\/])')
+#Words the query parser reads as operators, quoted when they are a whole value or word.
+solr_operators = ("AND","OR","NOT")
+#Range queries such as [NOW-1YEAR TO NOW] on date and number fields.
+solr_range = re.compile(r'^[\[{](\S+) TO (\S+)[\]}]$')
+
+def escape_value(value,match=False):
+    """ 
+    Escapes a search value for use in a Solr query.
+
+    Parameters: 
+
+        value (str): Value given by the user, a value in double quotes is a phrase.
+
+        match (bool): Build an exact phrase instead of a term query.
 
     Returns: 
-    str: Either the appended search string or the original if the validation fails. 
+    str: Escaped value
     """
-    if request.args.get(name):
-        if ":" not in request.args.get(name):
-            return searchstring+" AND "+name+":"+request.args.get(name)
+    value=str(value)
+    if not match and len(value)>1 and value[0]=='"' and value[-1]=='"':
+        return escape_value(value[1:-1],True)
+    if match:
+        return '"'+value.replace('\\','\\\\').replace('"','\\"')+'"'
+    bounds=solr_range.match(value)
+    if bounds:
+        return value[0]+escape_value(bounds.group(1))+" TO "+escape_value(bounds.group(2))+value[-1]
+    if value=="*":
+        return value
+    value=solr_special_characters.sub(r'\\\1',value)
+    words=value.split()
+    if len(words)>1:
+        return "("+" ".join('"'+word+'"' if word in solr_operators else word for word in words)+")"
+    if value in solr_operators:
+        return '"'+value+'"'
+    return value
+
+def compile_search(search):
+    """ 
+    Compiles the "search" tree of a structured POST search into a Solr query and filter queries.
+    The publication status and groups that only select facet values are emitted as fq so Solr
+    can reuse its filterCache. Compiled queries are memoized by a hash of the normalized tree.
+
+    Parameters: 
+
+        search (list): Groups eg. [{"group":"and","and":[{"string":"x","field":"keywords","type":"match"}]}]
+
+    Returns: 
+    tuple: q string and tuple of fq strings
+    """
+    try:
+        key=hashlib.sha1(json.dumps(search,sort_keys=True).encode('utf-8')).hexdigest()
+    except (TypeError,ValueError):
+        raise SearchQueryError("search must be a list of groups")
+    compiled=compiled_searches.get(key)
+    if compiled is not None:
+        return compiled
+    operators=['AND','NOT','OR']
+    if not isinstance(search,list):
+        raise SearchQueryError("search must be a list of groups")
+    groups=[]
+    for group in search:
+        if not isinstance(group,dict) or str(group.get('group','')).upper() not in operators:
+            raise SearchQueryError("group must be one of and, or, not")
+        clauses=""
+        facetonly=True
+        for operator in group.keys():
+            if operator.upper() not in operators:
+                continue
+            if not isinstance(group[operator],list):
+                raise SearchQueryError(operator+" must be a list of queries")
+            for q in group[operator]:
+                if not isinstance(q,dict) or q.get('field') not in resource_fields:
+                    raise SearchQueryError("unknown field "+str(q.get('field') if isinstance(q,dict) else q))
+                if q.get('type') not in ['simple','match'] or 'string' not in q:
+                    raise SearchQueryError("query type must be simple or match and have a string")
+                if clauses:
+                    clauses+=" "+operator.upper()+" "
+                clauses+=q['field']+":"+escape_value(q['string'],q['type']=='match')
+                facetonly=facetonly and "facet_"+q['field'] in resources_facets
+        if clauses:
+            groups.append((group['group'].upper(),"("+clauses+")",facetonly))
+    q="*:*"
+    fq=["status:true"]
+    filterable=all(op!='OR' for op,clauses,facetonly in groups)
+    for op,clauses,facetonly in groups:
+        if filterable and facetonly:
+            fq.append(clauses if op=='AND' else "-"+clauses)
         else:
-            return searchstring
-    else:
-        return searchstring
+            q+=" "+op+" "+clauses
+    compiled=(q,tuple(fq))
+    compiled_searches.set(key,compiled)
+    return compiled
 
 class User(UserMixin):
     """ 
@@ -61,6 +1168,96 @@ class User(UserMixin):
         self.name = name
 
 
+#Users loaded by load_user keyed by id, so authenticated requests rarely query the users core.
+#Group changes propagate within USER_CACHE_TTL seconds.
+if app.config.get("USER_CACHE_REDIS_URL"):
+    user_cache = RedisCache(app.config["USER_CACHE_REDIS_URL"],"dmtclearinghouse:user:",ttl=app.config.get("USER_CACHE_TTL",60))
+else:
+    user_cache = TTLCache(maxsize=app.config.get("USER_CACHE_SIZE",1024),ttl=app.config.get("USER_CACHE_TTL",60))
+index_versions.on_change("users",user_cache.clear)
+
+def admin_required(function):
+    """ 
+    Decorator for routes only available to logged in members of ADMIN_GROUPS.
+    """
+    @wraps(function)
+    def decorated(*args,**kwargs):
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        if not set(current_user.groups) & set(app.config.get("ADMIN_GROUPS",["administrator"])):
+            return {"error":"Not authorized"}, 403
+        return function(*args,**kwargs)
+    return decorated
+
+class TokenBucket(object):
+    """ 
+    In memory token buckets keyed by eg. username or IP, used to throttle login attempts.
+
+    Parameters: 
+
+        rate (float): Tokens added per second.
+
+        burst (int): Maximum number of tokens in a bucket.
+
+        maxsize (int): Maximum number of buckets kept, the least recently used are dropped.
+    """
+    def __init__(self,rate,burst,maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = TTLCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def allow(self,key):
+        """ 
+        Takes a token from the bucket of key, returns False when it is empty.
+        """
+        now=time.monotonic()
+        with self._lock:
+            tokens,last=self.buckets.get(key,(self.burst,now))
+            tokens=min(self.burst,tokens+(now-last)*self.rate)
+            if tokens<1:
+                self.buckets.set(key,(tokens,now))
+                return False
+            self.buckets.set(key,(tokens-1,now))
+            return True
+
+    def retry_after(self):
+        return max(1,int(1/self.rate))
+
+def verify_password(password,encoded,count):
+    """ 
+    Verifies a password against a Drupal hash, run on the login pool.
+    Parameters: 
+
+        password (str): Password given by the user.
+
+        encoded (str): Stored Drupal hash.
+
+        count (int): Wanted log2 of the hash iterations.
+
+    Returns:
+        tuple: True when the password matches and a new hash when the stored one has another cost
+    """
+    import drupal_hash_utility
+    utility=drupal_hash_utility.DrupalHashUtility()
+    if not utility.verify(password,encoded):
+        return False,None
+    if encoded[:3]=="$S$" and utility._i2b64.index(encoded[3])==count:
+        return True,None
+    utility._DRUPAL_HASH_COUNT=count
+    return True,utility.encode(password)
+
+#Login attempts allowed per username and per IP, LOGIN_RATE per minute with bursts of LOGIN_BURST.
+login_throttle = TokenBucket(app.config.get("LOGIN_RATE",10)/60.0,app.config.get("LOGIN_BURST",5))
+#Drupal hashes are deliberately slow, they are verified on a bounded pool so logins can not pin every thread.
+if app.config.get("LOGIN_POOL","thread")=="process":
+    login_executor = ProcessPoolExecutor(max_workers=app.config.get("LOGIN_WORKERS",2))
+else:
+    login_executor = ThreadPoolExecutor(max_workers=app.config.get("LOGIN_WORKERS",2))
+#Logins hashing or waiting to hash are bounded below the WSGI thread count (SOLR_POOL_SIZE), further logins get a 503.
+#A slot is released when its hash finishes, also when the request stopped waiting after LOGIN_TIMEOUT seconds.
+login_slots = threading.BoundedSemaphore(app.config.get("LOGIN_WORKERS",2)+app.config.get("LOGIN_QUEUE",max(0,app.config.get("SOLR_POOL_SIZE",5)-1-app.config.get("LOGIN_WORKERS",2))))
+
 #Callback for login_user
 @login_manager.user_loader
 def load_user(user_id):
@@ -73,12 +1270,17 @@ def load_user(user_id):
     Returns:
         User object or None
     """
-    userobj=users.search("id:\""+user_id+"\"", rows=1)
-    for user in userobj:
-        user.pop('_version_', None)
-        user.pop('hash', None)
-        return User(user['id'],user['groups'],user['name'])
-    return None
+    #Polls the users index version when due, a change drops the cached users.
+    index_versions.current("users")
+    user=user_cache.get(user_id)
+    if user is None:
+        userobj=users.search("id:\""+user_id+"\"", rows=1)
+        for result in userobj:
+            user={"id":result['id'],"groups":result['groups'],"name":result['name']}
+            user_cache.set(user_id,user)
+    if user is None:
+        return None
+    return User(user['id'],user['groups'],user['name'])
 
 
 #internal user with hash
@@ -98,108 +1300,799 @@ def get_user(user_name):
         return user
     return None
 #Format Solr Return for end user:
-def format_resource(results):
-    #print(results)
-    returnval= json.loads('{ "documentation":"'+request.host_url+'api/resources/documentation.html","results":[], "facets":{}}')
-    for result in results:
-        #print(result)
-        result.pop('_version_', None)
-        result.pop('status', None)
-        list_keys = list(result.keys())
-        for k in list_keys:
-            if k.startswith('facet_'):
-                result.pop(k)
-
-        if "contributors.firstname" in result.keys():
-            result['contributors']=[]
-            if result["contributors.firstname"]:
-                for i in range(len(result["contributors.firstname"])):
-                    contributor=json.loads('{}')
-                    contributor['firstname']=result["contributors.firstname"][i]
-                    if "contributors.lastname" in result.keys():
-                        contributor['lastname']=result["contributors.lastname"][i]
-                    if "contributors.type" in result.keys():
-                        contributor['type']=result["contributors.type"][i]
-                    result['contributors'].append(contributor)
-        if "contributor_orgs.name" in result.keys():
-            result['contributor_orgs']=[]
-            for i in range(len(result["contributor_orgs.name"])):
-                contributor=json.loads('{}')
-                contributor['name']=result["contributor_orgs.name"][i]
-                
-                if "contributor_orgs.type" in result.keys():
-                    contributor['type']=result["contributor_orgs.type"][i]
-                    
-                result['contributor_orgs'].append(contributor)
-        result.pop('contributor_orgs.type', None)
-        result.pop('contributor_orgs.name', None)
-        result.pop('contributors.firstname', None)
-        result.pop('contributors.lastname', None)
-        result.pop('contributors.type', None)
-        returnval['results'].append(result)
-    #print(results.facets)
-    if "facet_fields" in results.facets.keys():
-        for rf in resources_facets:
-            rfobject={}
-            if rf in results.facets['facet_fields'].keys():
-                for value,number in zip(results.facets['facet_fields'][rf][0::2], results.facets['facet_fields'][rf][1::2]):
-                    if number>0:
-                        rfobject[value]=number
-            #print(rfobject)
-            returnval['facets'][rf.replace('facet_','')]=rfobject
+class FieldPlan(object):
+    """ 
+    Per document transform of learning resources, computed once from the Solr schema.
+    Lists the fields to request with fl, the internal fields to drop and the parallel
+    contributor arrays to zip into nested objects.
+
+    Parameters: 
+
+        fieldnames (list): Field names of the learningresources schema, None when the schema is unknown.
+    """
+    #Nested object: (lead field, [(key, field)]). The lead field decides the number of objects.
+    nested = [("contributors","contributors.firstname",[("firstname","contributors.firstname"),("lastname","contributors.lastname"),("type","contributors.type")]),
+              ("contributor_orgs","contributor_orgs.name",[("name","contributor_orgs.name"),("type","contributor_orgs.type")])]
+    internal = ["_version_","status"]
+
+    def __init__(self,fieldnames=None):
+        self.fl = None
+        self.params = {}
+        self.names = None
+        self.drop = list(self.internal)
+        if fieldnames is not None:
+            self.drop += [name for name in fieldnames if name.startswith('facet_')]
+            self.names = [name for name in fieldnames if name not in self.drop]
+            self.fl = ",".join(self.names)
+            self.params = {"fl":self.fl}
+
+    def projection(self,fields):
+        """ 
+        Returns the fl of a subset of the formatted fields, validated against the schema.
+        contributors and contributor_orgs select their parallel arrays, id is always included.
+
+        Parameters: 
+
+            fields (list): Field names as returned to the end user eg. ["title","url"]
+
+        Returns: 
+        str: Solr fl
+        """
+        names=["id"]
+        for field in fields:
+            nested=[columns for name,lead,columns in self.nested if name==field]
+            if nested:
+                columns=[column for key,column in nested[0]]
+            elif field in self.drop or field.startswith('facet_') or (self.names is not None and field not in self.names) or not solr_field_name.match(field):
+                raise SearchQueryError("unknown field "+field)
+            else:
+                columns=[field]
+            names+=[column for column in columns if column not in names]
+        return ",".join(names)
+
+    def apply(self,result):
+        """ 
+        Formats a Solr document in place.
+        """
+        for name in self.drop:
+            result.pop(name, None)
+        if self.fl is None:
+            for k in [k for k in result if k.startswith('facet_')]:
+                del result[k]
+        for name,lead,columns in self.nested:
+            if lead not in result:
+                for key,field in columns:
+                    result.pop(field, None)
+                continue
+            count=len(result[lead] or ())
+            keys=[]
+            values=[]
+            for key,field in columns:
+                column=result.pop(field, None)
+                if column is None or count==0:
+                    continue
+                if len(column)<count:
+                    column=column+[None]*(count-len(column))
+                keys.append(key)
+                values.append(column)
+            result[name]=[dict(zip(keys,row)) for row in zip(*values)]
+        return result
+
+def resource_plan():
+    """ 
+    Returns the FieldPlan of learning resources, cached with the schema.
+    Falls back to a plan without fl when the schema can not be fetched, kept for
+    SCHEMA_RETRY seconds so a failing schema API is not asked on every search.
+    """
+    plan=schema_cache.get(("plan","learningresources"))
+    if plan is None:
+        try:
+            fields=get_schema("learningresources")['fields']
+        except Exception:
+            app.logger.warning("The learningresources schema could not be loaded, searches return every field.")
+            schema_cache.set(("plan","learningresources"),fallback_plan,ttl=app.config.get("SCHEMA_RETRY",30))
+            return fallback_plan
+        plan=FieldPlan([field['name'] for field in fields])
+        schema_cache.set(("plan","learningresources"),plan)
+    return plan
+
+#Used when the learningresources schema is not available.
+fallback_plan = FieldPlan()
+#Without a schema requested fields are only checked to be plain field names.
+solr_field_name = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+def projection_params(fields=None,highlight=False):
+    """ 
+    Builds the field list and highlighting parameters of a resource search.
+
+    Parameters: 
+
+        fields (list): Fields to return, None for every field.
+
+        highlight (bool): Add a highlighted abstract.data snippet to every result.
+
+    Returns: 
+    dict: Solr parameters
+    """
+    plan=resource_plan()
+    params=dict(plan.params)
+    if fields is not None:
+        params['fl']=plan.projection(fields)
+    if highlight:
+        params.update({"hl":"on","hl.fl":"abstract.data","hl.snippets":1,"hl.fragsize":app.config.get("HIGHLIGHT_FRAGSIZE",200)})
+    return params
+
+def add_highlight(result,highlighting):
+    """ 
+    Adds the highlighted abstract snippet of a result, keyed by id in the Solr response.
+    """
+    snippets=highlighting.get(result.get('id'),{}).get("abstract.data")
+    if snippets:
+        result['highlight']=snippets[0]
+    return result
+
+def dumps(value):
+    """ 
+    Serializes value to compact JSON bytes, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value,separators=(",",":")).encode('utf-8')
+
+def format_resource(results,host_url=None):
+    """ 
+    Formats a Solr search response of learning resources for the end user.
+
+    Parameters: 
+
+        results (Results): pysolr results.
+
+        host_url (str): Host the documentation link points to, defaults to the host of the request.
+
+    Returns: 
+    dict: Formatted results, facets and hit counts
+    """
+    if host_url is None:
+        host_url=request.host_url
+    returnval={"documentation":host_url+"api/resources/documentation.html","results":[],"facets":{}}
+    plan=resource_plan()
+    returnval['results']=[plan.apply(result) for result in results.docs]
+    if results.highlighting:
+        for result in returnval['results']:
+            add_highlight(result,results.highlighting)
+    returnval['facets']=format_facet_fields(results)
     returnval['hits-total']=results.hits
-    returnval['hits-returned']=len(results)
+    returnval['hits-returned']=len(results.docs)
+    if results.nextCursorMark is not None:
+        returnval['next-cursor']=results.nextCursorMark
     return returnval
+
+def format_facet_fields(results):
+    """ 
+    Formats the facet.field counts of a Solr response as {facet:{value:count}}.
+    """
+    formatted={}
+    #Facets are requested with facet.mincount=1 so Solr only returns non zero counts.
+    facet_fields=results.facets.get("facet_fields",{})
+    for rf in resources_facets:
+        if rf in facet_fields:
+            counts=iter(facet_fields[rf])
+            formatted[rf.replace('facet_','')]=dict(zip(counts,counts))
+    return formatted
+
+def page_params(rows,start=0,cursor=None,maxrows=None):
+    """ 
+    Builds the Solr paging parameters of a search.
+    rows is capped at maxrows and a cursor switches to deep paging with cursorMark.
+
+    Parameters: 
+
+        rows (int): Requested number of results.
+
+        start (int): Requested offset, not allowed with a cursor.
+
+        cursor (str): '*' for the first page or the next-cursor of the previous page.
+
+        maxrows (int): Largest allowed page, defaults to MAX_ROWS.
+
+    Returns: 
+    dict: Solr parameters
+    """
+    if maxrows is None:
+        maxrows=app.config.get("MAX_ROWS",100)
+    params={"rows":min(rows,maxrows)}
+    if cursor is None:
+        params['start']=start
+        return params
+    if start or not isinstance(cursor,str):
+        raise SearchQueryError("cursor must be a string and can not be combined with offset")
+    params['cursorMark']=cursor
+    params['sort']="score desc,id asc"
+    return params
+
+def build_get_query(args):
+    """ 
+    Builds the Solr query for the search arguments of a GET on /api/resources/.
+    Only the arguments present are looked at, in the field registry fed by the ;;field lines.
+    Values are escaped, repeated arguments are ORed and facetable fields become fq filters.
+
+    Parameters: 
+
+        args (MultiDict): request.args of the request.
+
+    Returns: 
+    tuple: q string and list of fq strings
+    """
+    clauses=[]
+    fq=["status:true"]
+    for name in args:
+        if name not in resource_fields:
+            continue
+        values=[escape_value(value) for value in args.getlist(name) if value]
+        if not values:
+            continue
+        if len(values)==1:
+            clause=name+":"+values[0]
+        else:
+            clause=name+":("+" OR ".join(values)+")"
+        if "facet_"+name in resources_facets:
+            fq.append(clause)
+        else:
+            clauses.append(clause)
+    q=" AND ".join(clauses) or "*:*"
+    return q,fq
+
+def get_search_params(args,maxrows=None):
+    """ 
+    Builds the Solr parameters of a GET search on /api/resources/.
+
+    Parameters: 
+
+        args (MultiDict): request.args of the request.
+
+        maxrows (int): Largest allowed page, defaults to MAX_ROWS.
+
+    Returns: 
+    dict: Solr parameters
+    """
+    q,fq=build_get_query(args)
+    rows=10
+    if args.get("limit"):
+        if args.get("limit").isnumeric():
+            rows=int(args.get("limit"))
+    params={"q":q,"fq":fq}
+    params.update(page_params(rows,cursor=args.get("cursor"),maxrows=maxrows))
+    fields=None
+    if args.get("fields"):
+        fields=[field.strip() for field in args.get("fields").split(",") if field.strip()]
+    params.update(projection_params(fields,args.get("highlight")=="true"))
+    return params
+
+def search_resources_get(request):
+    """ 
+    Builds and runs the Solr search for a GET on /api/resources/.
+
+    Parameters: 
+
+        request (request):  The full request made to a route.
+
+    Returns: 
+    dict: Formatted results
+    """
+    try:
+        with span("query"):
+            params=get_search_params(request.args)
+    except SearchQueryError as error:
+        return {"error":str(error)}, 400
+    results=resources.search(**params)
+    with span("format"):
+        return format_resource(results)
+
+def post_search_params(content,maxrows=None):
+    """ 
+    Builds the Solr parameters of a structured POST search on /api/resources/.
+
+    Parameters: 
+
+        content (dict): JSON body of the request.
+
+        maxrows (int): Largest allowed page, defaults to MAX_ROWS.
+
+    Returns: 
+    tuple: Solr parameters without facets and the list of requested facet fields
+    """
+    facets=requested_facets(content.get('facets',True))
+    q,fq=compile_search(content.get('search',[]))
+    rows=content.get('limit',10)
+    start=content.get('offset',0)
+    if type(rows) is not int or type(start) is not int or rows<0 or start<0:
+        raise SearchQueryError("limit and offset must be positive integers")
+    params={"q":q,"fq":list(fq)}
+    params.update(page_params(rows,start,content.get('cursor'),maxrows))
+    fields=content.get('fields')
+    if isinstance(fields,str):
+        fields=[field.strip() for field in fields.split(",") if field.strip()]
+    if fields is not None and not (isinstance(fields,list) and all(isinstance(field,str) for field in fields)):
+        raise SearchQueryError("fields must be a list of field names")
+    highlight=content.get('highlight',False)
+    if not isinstance(highlight,bool):
+        raise SearchQueryError("highlight must be true or false")
+    params.update(projection_params(fields,highlight))
+    return params,facets
+
+def search_resources_post(content):
+    """ 
+    Builds and runs the Solr search for a structured POST on /api/resources/.
+
+    Parameters: 
+
+        content (dict): JSON body of the request.
+
+    Returns: 
+    dict: Formatted results or an error response
+    """
+    try:
+        with span("query"):
+            params,facets=post_search_params(content)
+    except SearchQueryError as error:
+        return {"error":str(error)}, 400
+    params.update(facet_field_params(facets))
+    results=resources.search(**params)
+    with span("format"):
+        return format_resource(results)
+
+def facet_field_params(facets):
+    """ 
+    Builds the classic facet parameters counting the given facet fields, without zero counts.
+    """
+    if not facets:
+        return {}
+    return {"facet":"on","facet.field":facets,"facet.mincount":1}
+
+def stream_resources(params,host_url):
+    """ 
+    Runs a search in pages of STREAM_PAGE_SIZE and returns its JSON response as a generator of
+    byte chunks: the envelope, each formatted resource as it is produced, then facets and hit counts.
+    Memory use is bounded by a page instead of the whole response. The first page is fetched
+    before returning so Solr errors still become error responses.
+
+    Parameters: 
+
+        params (dict): Solr parameters from get_search_params or post_search_params.
+
+        host_url (str): Host the documentation link points to.
+
+    Returns: 
+    generator: JSON response in chunks
+    """
+    plan=resource_plan()
+    rows=params['rows']
+    pagesize=max(1,app.config.get("STREAM_PAGE_SIZE",100))
+    page=dict(params,rows=min(rows,pagesize))
+    results=resources.search(**page)
+    def generate(results):
+        yield b'{"documentation":'+dumps(host_url+"api/resources/documentation.html")+b',"results":['
+        facets=format_facet_fields(results)
+        hits=results.hits
+        returned=0
+        while True:
+            for result in results.docs:
+                result=add_highlight(plan.apply(result),results.highlighting)
+                if returned:
+                    yield b","+dumps(result)
+                else:
+                    yield dumps(result)
+                returned+=1
+            cursor=results.nextCursorMark
+            if len(results.docs)<page['rows'] or returned>=rows or ('cursorMark' in page and cursor==page['cursorMark']):
+                break
+            for name in ("facet","facet.field","facet.mincount"):
+                page.pop(name,None)
+            page['rows']=min(rows-returned,pagesize)
+            if cursor is not None:
+                page['cursorMark']=cursor
+            else:
+                page['start']=params['start']+returned
+            results=resources.search(**page)
+        yield b'],"facets":'+dumps(facets)+b',"hits-total":'+str(hits).encode()+b',"hits-returned":'+str(returned).encode()
+        if cursor is not None:
+            yield b',"next-cursor":'+dumps(cursor)
+        yield b"}"
+    return generate(results)
+
+def batch_ids(ids):
+    """ 
+    Validates the ids of a batch lookup.
+
+    Parameters: 
+
+        ids (list): Requested ids, duplicates are removed keeping the first occurrence.
+
+    Returns: 
+    list: ids in requested order
+    """
+    if not isinstance(ids,list) or not all(isinstance(i,str) and i and "," not in i for i in ids):
+        raise SearchQueryError("ids must be a list of resource ids")
+    ids=list(OrderedDict.fromkeys(ids))
+    maximum=app.config.get("BATCH_MAX_IDS",100)
+    if len(ids)>maximum:
+        raise SearchQueryError("at most "+str(maximum)+" ids can be requested at once")
+    return ids
+
+def lookup_resources(ids,host_url=None):
+    """ 
+    Fetches published learning resources by id with a single real-time get.
+
+    Parameters: 
+
+        ids (list): Resource ids, validated by batch_ids.
+
+        host_url (str): Host the documentation link points to, defaults to the host of the request.
+
+    Returns: 
+    dict: Formatted resources in requested order and the ids that were not found
+    """
+    if host_url is None:
+        host_url=request.host_url
+    plan=resource_plan()
+    found={}
+    if ids:
+        params={"ids":",".join(ids),"fq":"status:true","wt":"json"}
+        params.update(plan.params)
+        docs=resources.get_json("get",params)['response']['docs']
+        with span("format"):
+            for result in docs:
+                found[result['id']]=plan.apply(result)
+    returnval={"documentation":host_url+"api/resources/documentation.html"}
+    returnval['results']=[found[i] for i in ids if i in found]
+    returnval['missing']=[i for i in ids if i not in found]
+    returnval['hits-returned']=len(returnval['results'])
+    return returnval
+
+def requested_facets(facets):
+    """ 
+    Resolves the facets asked for by a client to Solr facet fields.
+
+    Parameters: 
+
+        facets (bool or list): True for all facets, False for none or a list of names eg. ["type","subject"]
+
+    Returns: 
+    list: Solr facet fields
+    """
+    if facets is True:
+        return resources_facets
+    if facets is False or facets is None:
+        return []
+    if not isinstance(facets,list):
+        raise SearchQueryError("facets must be true, false or a list of facet names")
+    fields=[]
+    for name in facets:
+        if "facet_"+str(name) not in resources_facets:
+            raise SearchQueryError("unknown facet "+str(name))
+        fields.append("facet_"+name)
+    return fields
+
+def search_facets(request,facets):
+    """ 
+    Counts facet values of the published resources matching the GET search arguments
+    with the Solr JSON Facet API, zero counts never leave Solr.
+
+    Parameters: 
+
+        request (request):  The full request made to a route.
+
+        facets (list): Solr facet fields.
+
+    Returns: 
+    dict: Facet counts
+    """
+    with span("query"):
+        q,fq=build_get_query(request.args)
+    results=resources.search(q, fq=fq, rows=0, **json_facet_params(facets))
+    returnval={"documentation":request.host_url+"api/resources/documentation.html"}
+    with span("format"):
+        returnval['facets']=format_json_facets(results.raw_response,facets)
+    returnval['hits-total']=results.hits
+    return returnval
+
+def json_facet_params(facets):
+    """ 
+    Builds the json.facet parameter counting the given facet fields, without zero buckets.
+    """
+    jsonfacet={}
+    for rf in facets:
+        jsonfacet[rf]={"type":"terms","field":rf,"mincount":1,"limit":app.config.get("FACET_LIMIT",-1)}
+    return {"json.facet":json.dumps(jsonfacet)}
+
+def format_json_facets(response,facets):
+    """ 
+    Formats the JSON Facet API buckets of a Solr response as {facet:{value:count}}.
+    """
+    facetcounts=response.get("facets",{})
+    formatted={}
+    for rf in facets:
+        buckets=facetcounts.get(rf,{}).get("buckets",[])
+        formatted[rf.replace('facet_','')]={bucket['val']:bucket['count'] for bucket in buckets}
+    return formatted
+
+def version_etag(core,key,stamp=None):
+    """ 
+    Derives the ETag of a response from the index version of core, the invalidation stamp
+    and the normalized request, so it is known without running the search.
+
+    Parameters: 
+
+        core (str): Core the response is built from.
+
+        key (tuple): Normalized request.
+
+        stamp (InvalidationStamp): Stamp whose touch also changes the ETag.
+
+    Returns: 
+    str: ETag or None when the index version is unknown
+    """
+    version=index_versions.current(core)
+    if version is None:
+        return None
+    mtime=None
+    if stamp is not None:
+        mtime=stamp.mtime
+    return hashlib.sha1(repr((core,version,mtime,key)).encode('utf-8')).hexdigest()
+
+def cache_headers(resp,etag,max_age):
+    """ 
+    Sets the ETag and Cache-Control of a response and answers If-None-Match with a 304.
+    """
+    if etag is not None:
+        resp.set_etag(etag)
+    resp.cache_control.public=True
+    resp.cache_control.max_age=max_age
+    return resp.make_conditional(request)
+
+def not_modified(etag,max_age):
+    """ 
+    Returns a 304 response when the request already holds etag, None otherwise.
+    """
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    return cache_headers(make_response("",304),etag,max_age)
+
+def cache_search(key,search,cache):
+    """ 
+    Runs search and caches its JSON body and hash under key.
+
+    Returns: 
+    tuple: The cached body and hash, or None and the error response of search
+    """
+    returnval=search()
+    if not isinstance(returnval,dict):
+        return None,returnval
+    body=app.json.response(returnval).get_data()
+    cached=(body,hashlib.sha1(body).hexdigest())
+    cache.set(key,cached)
+    return cached,None
+
+def record_search(key,offset=None,cursor=None):
+    """ 
+    Counts a search for the warmer under its result cache key, when it asks for the first page.
+    """
+    if offset in (None,0) and cursor in (None,"*"):
+        search_stats.record(key)
+
+def cached_search(key,search,cache=None):
+    """ 
+    Serves a search from the result cache, running search and caching its JSON on a miss.
+    Responses carry an ETag derived from the learningresources index version and Cache-Control,
+    a matching If-None-Match is answered with 304 without a cache lookup or a Solr request.
+
+    Parameters: 
+
+        key (tuple): Normalized search.
+
+        search (function): Runs the search and returns the formatted results or an error response.
+
+        cache (TTLCache): Cache to use, defaults to the result cache.
+
+    Returns: 
+    response: JSON results
+    """
+    if cache is None:
+        cache=result_cache
+    results_stamp.check()
+    max_age=app.config.get("RESULT_CACHE_TTL",300)
+    etag=version_etag("learningresources",key,results_stamp)
+    search_warmer.check()
+    resp=not_modified(etag,max_age)
+    if resp is not None:
+        return resp
+    cached=cache.get(key)
+    if cached is None:
+        cached,error=cache_search(key,search,cache)
+        if cached is None:
+            return error
+    resp=make_response(cached[0])
+    resp.mimetype='application/json'
+    return cache_headers(resp,etag or cached[1],max_age)
+
+def lookup_vocabularies(index,args,host_url):
+    """ 
+    Answers a GET on /api/vocabularies/ from the in memory vocabularies.
+
+    Parameters: 
+
+        index (VocabularyIndex): Current vocabularies.
+
+        args (MultiDict): request.args of the request.
+
+        host_url (str): Host the documentation link points to.
+
+    Returns: 
+    dict: Vocabularies, vocabulary names or completed values
+    """
+    documentation=host_url+'api/vocabularies/documentation.html'
+    if args.get("names")=="true":
+        return {"documentation":documentation,"names":index.names()}
+    name=args.get("name")
+    values=args.get("values")
+    id=args.get("id")
+    if args.get("prefix") is not None:
+        ids=None
+        if name is not None or values is not None or id is not None:
+            ids=set(vocabulary['id'] for vocabulary in index.search(name,values,id))
+        limit=args.get("limit","10")
+        limit=min(int(limit),app.config.get("MAX_ROWS",100)) if limit.isnumeric() else 10
+        found=index.complete(args.get("prefix"),limit,ids)
+        return {"documentation":documentation,"values":found,"hits-returned":len(found)}
+    results=index.search(name,values,id)
+    return {"documentation":documentation,"results":results,"hits":len(results),"hits-returned":len(results)}
+
+#Solr schema
+def get_schema(core):
+    """
+    Internal function returning the end user schema description of a Solr core.
+    Fields are fetched from the Solr schema API and cached for SCHEMA_CACHE_TTL seconds.
+    Parameters: 
+
+        core (str): Name of the Solr core eg. learningresources
+
+    Returns:
+        dict with description and fields
+    """
+    schema_stamp.check()
+    schemajson=schema_cache.get(core)
+    if schemajson is not None:
+        return schemajson
+    fields=solr.core(core).get_json("schema/fields",operation="schema")['fields']
+    schemajson=schema_from_fields(fields)
+    schema_cache.set(core,schemajson)
+    return schemajson
+
+def schema_from_fields(fields):
+    """
+    Internal function building the end user schema description from the Solr schema API fields.
+    Parameters: 
+
+        fields (list): Fields returned by the schema/fields handler.
+
+    Returns:
+        dict with description and fields
+    """
+    typemap={"text_general":"General Text","boolean":"Boolean","pdate":"Datetime","string":"Exact Match String","pfloat":"Floating Point"}
+    schemajson={"description":"Learning Resources Schema", "fields":[]}
+    for field in fields:
+        if not field['name'].startswith( '_' ):
+            thisfield={}
+            thisfield['name']=field['name']
+            thisfield['type']=typemap[field['type']]
+            thisfield['multivalue']=field['multiValued']
+            thisfield['required']=field['required']
+            schemajson['fields'].append(thisfield)
+    return schemajson
+
+def schema_pdf_name(collection,schemajson):
+    """
+    Internal function returning the file name of a schema PDF in pdf_store, which changes with the schema.
+    """
+    return collection+"-"+hashlib.sha1(json.dumps(schemajson,sort_keys=True).encode('utf-8')).hexdigest()+".pdf"
+
+def render_schema_pdf(collection,schemajson):
+    """
+    Internal function rendering a schema PDF, run as a pdf_store job outside of any request.
+    Parameters: 
+
+        collection (str): Collection name shown in the document.
+
+        schemajson (dict): Schema from get_schema.
+
+    Returns:
+        bytes: PDF document
+    """
+    with app.app_context():
+        html=render_template("schema.html", schemajson=schemajson, collection=collection)
+    with span("pdf"):
+        return write_pdf(html)
+
+def write_pdf(html):
+    #WeasyPrint loads cairo and pango, by far the slowest import, only PDF renders pay for it.
+    from weasyprint import HTML
+    return HTML(string=html).write_pdf()
+
 #Documentation generation
-def generate_documentation(docstring,document,request,jsonexample=False):
-    request_rule=request.url_rule
+def parse_docstring(docstring):
     """
-    Internal function for building documentation from docstring
+    Internal function for parsing the ;; api lines of a route docstring.
     Parameters: 
 
         docstring (str): docstring with api lines.
 
     Returns:
-        HTML or Markdown
+        dict with parameters, arguments, gettablefieldnames and postjsondata or None
     """
     if docstring is None:
-        return "Documentation not yet implemented for this route."
-    current_route=""
-    docjson=json.loads('{"methods":{}}')
-    for rule in app.url_map.iter_rules():
-        if request_rule==rule:
-            docjson['current_route']=str(request.url_rule).split("<")[0]
-            for r in rule.methods:
-                docjson['methods'][r]=json.loads('{"parameters":[],"arguments":[]}')
-
-    fields=[]
-    postjsondata=""
+        return None
+    parsed={"parameters":[],"arguments":[],"postjsondata":""}
     for line in docstring.splitlines():
-        if line.lstrip()[0:2]==";;":
-            if line.lstrip().split(":",1)[0]==";;field":
-                j=json.loads(line.split(":",1)[1])
-                #Due to documentation route will always have a 'GET' method.
-                docjson['methods']['GET']['parameters'].append(j)
-            if line.lstrip().split(":",1)[0]==";;argument":
-                j=json.loads(line.split(":",1)[1])
-                docjson['methods']['GET']['arguments'].append(j)
-            if line.lstrip().split(":",1)[0]==";;gettablefieldnames":
-                j=json.loads(line.split(":",1)[1])
-                docjson['gettablefieldnames']=j                
-            if line.lstrip().split(":",1)[0]==";;postjson":
-                j=json.loads(line.split(":",1)[1])
-                #print(j)
-                postjsondata=json.dumps(j,indent=2)
-                #print(postjsondata)
-
-
-    if document=="documentation.md":
-        resp=make_response(render_template(document, docjson=docjson))
-        resp.headers['Content-type'] = 'text/markdown; charset=UTF-8'
-        return resp
-    if document=="documentation.htm":
-        return render_template(document, docjson=docjson, jsonexample=jsonexample,postjsondata=postjsondata)
-    return render_template(document, docjson=docjson, jsonexample=jsonexample,postjsondata=postjsondata)
+        line=line.lstrip()
+        if line[0:2]!=";;":
+            continue
+        key,value=line.split(":",1)
+        if key==";;field":
+            parsed['parameters'].append(json.loads(value))
+        elif key==";;argument":
+            parsed['arguments'].append(json.loads(value))
+        elif key==";;gettablefieldnames":
+            parsed['gettablefieldnames']=json.loads(value)
+        elif key==";;postjson":
+            parsed['postjsondata']=json.dumps(json.loads(value),indent=2)
+    return parsed
+
+def generate_documentation(document,request,jsonexample=False):
+    """
+    Internal function for serving documentation built from the docstring of the requested route.
+    Rendered pages are memoized per route, document and host and served as conditional responses.
+    Parameters: 
+
+        document (str): Template to render eg. documentation.html
+
+        request (request):  The full request made to a route.
+
+        jsonexample (bool): Show the json example forms.
+
+    Returns:
+        HTML or Markdown
+    """
+    parsed=route_docs.get(request.endpoint)
+    if parsed is None:
+        return "Documentation not yet implemented for this route."
+    request_rule=request.url_rule
+    key=(request_rule.rule,document,request.host_url,jsonexample)
+    cached=documentation_cache.get(key)
+    if cached is None:
+        docjson={"methods":{}}
+        docjson['current_route']=str(request_rule).split("<")[0]
+        for r in request_rule.methods:
+            docjson['methods'][r]={"parameters":[],"arguments":[]}
+        #Due to documentation route will always have a 'GET' method.
+        docjson['methods']['GET']['parameters']=parsed['parameters']
+        docjson['methods']['GET']['arguments']=parsed['arguments']
+        if 'gettablefieldnames' in parsed:
+            docjson['gettablefieldnames']=parsed['gettablefieldnames']
+        with span("render",template=document):
+            body=render_template(document, docjson=docjson, jsonexample=jsonexample,postjsondata=parsed['postjsondata'])
+        mimetype='text/html'
+        if document=="documentation.md":
+            mimetype='text/markdown'
+        cached=(body,mimetype,hashlib.sha1(body.encode('utf-8')).hexdigest())
+        documentation_cache.set(key,cached)
+    body,mimetype,etag=cached
+    resp=make_response(body)
+    resp.headers['Content-type'] = mimetype+'; charset=UTF-8'
+    resp.set_etag(etag)
+    resp.last_modified=app_started
+    resp.cache_control.public=True
+    resp.cache_control.max_age=app.config.get("DOCUMENTATION_MAX_AGE",3600)
+    return resp.make_conditional(request)
 
 ######################
 #Routes and Handelers#
@@ -226,6 +2119,10 @@ def learning_resources(document):
         Parameters: 
 
             request (request):  The full request made to a route.
+            The JSON body holds search, limit, offset or cursor and facets, which is
+            true for all facets (default), false for none or a list of facet names.
+            "stream":true streams the response like the stream argument of GET.
+            fields (a list or comma separated names) and highlight work as for GET.
 
         Returns: 
             json: JSON results from Solr 
@@ -266,7 +2163,14 @@ def learning_resources(document):
     ;;field:{"name":"completion_time","type":"string","example":"\\\"1 hour\\\"","description":""}
     ;;field:{"name":"media_type","type":"string","example":"\\\"Moving Image\\\"","description":""}
     ;;field:{"name":"type","type":"string","example":"\\\"Learning Activity\\\"","description":""}
-    ;;field:{"name":"limit","type":"int","example":"15","description":"Maximum number of results to return. Default is 10"}
+    ;;field:{"name":"id","type":"UUID","example":"8c3a9a9e-3b0a-4d0e-9f25-9a1b0c2f0f6b","description":"ID of the learning resource."}
+    ;;field:{"name":"created","type":"date","example":"[NOW-1YEAR TO NOW]","description":"Date the learning resource was created."}
+    ;;field:{"name":"published","type":"date","example":"[NOW-1YEAR TO NOW]","description":"Date the learning resource was published."}
+    ;;field:{"name":"limit","type":"int","example":"15","description":"Maximum number of results to return. Default is 10, at most 100"}
+    ;;field:{"name":"cursor","type":"string","example":"*","description":"Deep paging. Use * for the first page and the next-cursor of the previous response for the following pages."}
+    ;;field:{"name":"fields","type":"string","example":"title,url,contributors","description":"Comma separated fields to return instead of every field. The id is always returned."}
+    ;;field:{"name":"highlight","type":"boolean","example":"true","description":"Add a highlight snippet of abstract.data matching the search to every result."}
+    ;;field:{"name":"stream","type":"boolean","example":"true","description":"Stream the response one resource at a time, allowing up to 1000 results. Responses are not cached."}
     ;;gettablefieldnames:["Name","Type","Example","Description"]
     ;;postjson:{"search":[{"group":"and","and":[{"string":"Data archiving","field":"keywords","type":"match"}]}]}
     """
@@ -279,101 +2183,34 @@ def learning_resources(document):
 
     if request.method == 'GET':
         if document!="search.json":
-            return generate_documentation(learning_resources.__doc__,document,request,True)
-        
-        searchstring="status:true"
+            return generate_documentation(document,request,True)
+        if request.args.get("stream")=="true":
+            try:
+                params=get_search_params(request.args,app.config.get("STREAM_MAX_ROWS",1000))
+            except SearchQueryError as error:
+                return {"error":str(error)}, 400
+            return app.response_class(stream_resources(params,request.host_url), mimetype='application/json')
         
-        searchstring=append_searchstring(searchstring,request,"title")
-        searchstring=append_searchstring(searchstring,request,"url")
-        searchstring=append_searchstring(searchstring,request,"access_cost")
-        searchstring=append_searchstring(searchstring,request,"submitter_name")
-        searchstring=append_searchstring(searchstring,request,"submitter_email")
-        searchstring=append_searchstring(searchstring,request,"author")
-        searchstring=append_searchstring(searchstring,request,"author_org")
-        searchstring=append_searchstring(searchstring,request,"contact")
-        searchstring=append_searchstring(searchstring,request,"contact_org")
-        searchstring=append_searchstring(searchstring,request,"abstract.data")
-        searchstring=append_searchstring(searchstring,request,"subject")
-        searchstring=append_searchstring(searchstring,request,"keywords")
-        searchstring=append_searchstring(searchstring,request,"licence")
-        searchstring=append_searchstring(searchstring,request,"usage_rights")
-        searchstring=append_searchstring(searchstring,request,"citation.data")
-        searchstring=append_searchstring(searchstring,request,"locator.data")
-        searchstring=append_searchstring(searchstring,request,"locator.type")
-        searchstring=append_searchstring(searchstring,request,"publisher")
-        searchstring=append_searchstring(searchstring,request,"version")
-        searchstring=append_searchstring(searchstring,request,"created")
-        searchstring=append_searchstring(searchstring,request,"published")
-        searchstring=append_searchstring(searchstring,request,"access_features")
-        searchstring=append_searchstring(searchstring,request,"language_primary")
-        searchstring=append_searchstring(searchstring,request,"languages_secondary")
-        searchstring=append_searchstring(searchstring,request,"ed_framework")
-        searchstring=append_searchstring(searchstring,request,"ed_framework_dataone")
-        searchstring=append_searchstring(searchstring,request,"ed_framework_fair")
-        searchstring=append_searchstring(searchstring,request,"target_audience")
-        searchstring=append_searchstring(searchstring,request,"purpose")
-        searchstring=append_searchstring(searchstring,request,"completion_time")
-        searchstring=append_searchstring(searchstring,request,"media_type")
-        searchstring=append_searchstring(searchstring,request,"type")
-        searchstring=append_searchstring(searchstring,request,"author")
-        searchstring=append_searchstring(searchstring,request,"id")
-
-        rows=10
-        if request.args.get("limit"):
-            if request.args.get("limit").isnumeric():
-                rows=int(request.args.get("limit"))
-        results=resources.search(searchstring, rows=rows)
-        
-
-        return format_resource(results)
+        key=("GET",request.host_url,tuple(sorted(request.args.items(multi=True))))
+        record_search(key,cursor=request.args.get("cursor"))
+        return cached_search(key,lambda: search_resources_get(request))
 
 
     if request.method == 'POST':
-        params = {
-            'facet': 'on',
-            'facet.field':resources_facets
-            
-        }
-        operators=['AND','NOT','OR']
-        searchstring="status:true"
         if request.is_json:
             content = request.get_json()
-            if len(content['search'])>0:
-                for index, group in enumerate(content['search']):
-                    qindex=0
-                    if group['group'].upper() in operators:
-                        searchstring+=" "+group['group'].upper()+" ("
-                        for num, key in enumerate(group.keys()):
-                            if key.upper() in operators:
-                                for q in group[key]:
-                                    if q['type']=='simple':
-                                        if qindex>0:
-                                            searchstring+=" "+key.upper()+" "
-                                        qindex+=1
-                                        searchstring+=q['field']+":"+q['string']
-                                    elif q['type']=='match':
-                                        if qindex>0:
-                                            searchstring+=" "+key.upper()+" "
-                                        qindex+=1
-                                        searchstring+=q['field']+":\""+q['string']+"\""
-                        searchstring+=")"
-
-            if 'limit' in content.keys():
-                print(content['limit'])
-                rows=content['limit']
-            else:
-                rows=10
-
-            if 'offset' in content.keys():
-                print(content['offset'])
-                start=content['offset']
-            else:
-                start=0
-
-            
-            print(searchstring)
-            results=resources.search(searchstring, **params, rows=rows, start=start)
-            return format_resource(results)
+            if not isinstance(content,dict):
+                return {"error":"json body must be an object"}, 400
+            if content.get("stream") is True:
+                try:
+                    params,facets=post_search_params(content,app.config.get("STREAM_MAX_ROWS",1000))
+                except SearchQueryError as error:
+                    return {"error":str(error)}, 400
+                params.update(facet_field_params(facets))
+                return app.response_class(stream_resources(params,request.host_url), mimetype='application/json')
+            key=("POST",request.host_url,json.dumps(content,sort_keys=True))
+            record_search(key,content.get("offset"),content.get("cursor"))
+            return cached_search(key,lambda: search_resources_post(content))
         else:
             return 'json not found'
         return 'No query processed'
@@ -384,6 +2221,118 @@ def learning_resources(document):
     #default return for HEAD
     return "HEAD"    
 
+@app.route("/api/resources/facets", methods = ['GET'])
+def resource_facets():
+    """ 
+    GET:
+        Returns facet counts of published learning resources without fetching any resources.
+        The facet argument selects facets and may be repeated, the search arguments of
+        /api/resources/ filter the counted resources. Unfiltered counts are cached until the next purge.
+
+        Returns: 
+            json: Facet counts
+    """
+    try:
+        facets=requested_facets(request.args.getlist("facet") or True)
+    except SearchQueryError as error:
+        return {"error":str(error)}, 400
+    filters=tuple(sorted((k,v) for k,v in request.args.items(multi=True) if k!="facet"))
+    key=("FACETS",request.host_url,tuple(facets),filters)
+    cache=facet_cache
+    if filters:
+        cache=result_cache
+    return cached_search(key,lambda: search_facets(request,facets),cache)
+
+@app.route("/api/resources/batch", methods = ['GET','POST'])
+def resource_batch():
+    """ 
+    GET:
+        Returns the learning resources of a list of ids in one call, eg. ?ids=id1,id2
+        The id argument may also be repeated.
+    POST:
+        Same lookup with a JSON body {"ids":["id1","id2"]}.
+
+        Resources are fetched with a single Solr request and returned in requested order.
+        Ids that do not exist or are not published are listed under missing.
+        At most BATCH_MAX_IDS (default 100) ids are accepted.
+
+        Returns: 
+            json: Formatted resources and missing ids
+    """
+    if request.method == 'POST':
+        content=request.get_json(silent=True)
+        if not isinstance(content,dict):
+            return {"error":"json body must be an object"}, 400
+        ids=content.get("ids")
+    else:
+        ids=[i for value in request.args.getlist("ids") for i in value.split(",") if i]+request.args.getlist("id")
+    try:
+        ids=batch_ids(ids)
+    except SearchQueryError as error:
+        return {"error":str(error)}, 400
+    key=("BATCH",request.host_url,tuple(ids))
+    return cached_search(key,lambda: lookup_resources(ids))
+
+@app.route("/api/resources/suggest", methods = ['GET'])
+def resource_suggest():
+    """ 
+    GET:
+        Completes typed text with the terms of the facet fields of published learning resources,
+        eg. ?field=keywords&q=dat&limit=10. Without field every facet field is completed.
+        Suggestions are served from memory and ordered by the number of resources using them.
+        After an index change they are rebuilt in the background while the previous ones are served.
+
+        Returns: 
+            json: Suggested values with their counts
+    """
+    field=request.args.get("field")
+    prefix=request.args.get("q","").strip()
+    limit=request.args.get("limit","10")
+    if not limit.isnumeric():
+        return {"error":"limit must be a positive integer"}, 400
+    if field is not None and "facet_"+field not in resources_facets:
+        return {"error":"field must be one of "+", ".join(sorted(rf.replace('facet_','') for rf in resources_facets))}, 400
+    results_stamp.check()
+    max_age=app.config.get("RESULT_CACHE_TTL",300)
+    etag=version_etag("learningresources",("SUGGEST",field,prefix.lower(),limit),results_stamp)
+    resp=not_modified(etag,max_age)
+    if resp is not None:
+        return resp
+    index=suggest_index.current()
+    if field is not None:
+        suggestions=[dict(suggestion,field=field) for suggestion in index.complete(field,prefix,int(limit))]
+    else:
+        suggestions=[dict(suggestion,field=name) for name in index.fields for suggestion in index.complete(name,prefix,int(limit))]
+        suggestions=sorted(suggestions,key=lambda suggestion: -suggestion['count'])[:int(limit)]
+    resp=make_response({"q":prefix,"suggestions":suggestions})
+    if index.stale():
+        #Served from the previous copy while it is rebuilt, not tagged with the new index version.
+        resp.cache_control.no_cache=True
+        return resp
+    return cache_headers(resp,etag,max_age)
+
+@app.route("/api/resources/export.jsonl", methods = ['GET'])
+def export_resources():
+    """ 
+    GET:
+        Streams every published learning resource as JSON Lines, one formatted resource per line.
+        Resources are paged from Solr with cursorMark so memory use does not grow with the catalog.
+
+        Returns: 
+            application/x-ndjson
+    """
+    def generate():
+        cursor="*"
+        plan=resource_plan()
+        while True:
+            results=resources.search("*:*", fq="status:true", sort="id asc", rows=app.config.get("EXPORT_PAGE_SIZE",500), cursorMark=cursor, **plan.params)
+            for result in results.docs:
+                yield json.dumps(plan.apply(result))+"\n"
+            if results.nextCursorMark is None or results.nextCursorMark==cursor:
+                return
+            cursor=results.nextCursorMark
+    return app.response_class(generate(), mimetype='application/x-ndjson')
+
 @app.route("/api/",methods = ['GET'])
 def api():
     """ 
@@ -398,7 +2347,7 @@ def api():
     rulelist=[]
     for rule in app.url_map.iter_rules():
         if "/api/" in rule.rule:
-            if "<" not in rule.rule:
+            if "<" not in rule.rule and rule.rule.endswith("/"):
                 if rule.rule!="/api/":
                     rulelist.append(rule.rule+"documentation.html")
     return render_template('api.html',rulelist=rulelist)
@@ -418,6 +2367,8 @@ def schema(collection,returntype):
 
             collection (string):  An existing collection or 'documentation'
             returntype (string):  The mime type you want returned eg. html or pdf
+        PDFs are rendered in the background. Until the PDF is ready the response is 202 with
+        a job whose status-url reports progress, ?wait=true waits for the render instead.
         Returns: 
             returntype
     ;;argument:{"name":"documentation.html","description":"Show schema for the resources collection."}
@@ -443,37 +2394,150 @@ def schema(collection,returntype):
 
 
     if collection=="documentation":
-            return generate_documentation(schema.__doc__,collection+"."+returntype,request)
+            return generate_documentation(collection+"."+returntype,request)
 
     today = date.today().strftime("%d/%m/%Y")
-    typemap={"text_general":"General Text","boolean":"Boolean","pdate":"Datetime","string":"Exact Match String","pfloat":"Floating Point"}
     collectionmap={"resources":"learningresources","learningresources":"learningresources","vocabularies":"taxonomies","taxonomies":"taxonomies","user":"users","users":"users"}
-    r = requests.get(app.config["SOLR_ADDRESS"]+collectionmap[collection]+"/schema/fields")
-    schemajson=json.loads('{"description":"Learning Resources Schema", "fields":[]}')
-    if r.json():
-        for field in r.json()['fields']:
-            if not field['name'].startswith( '_' ):
-                thisfield=json.loads("{}")
-                thisfield['name']=field['name']
-                thisfield['type']=typemap[field['type']]
-                schemajson['fields'].append(thisfield)
-                thisfield['multivalue']=field['multiValued']
-                thisfield['required']=field['required']
-        if returntype=="json":
-            return(schemajson)
-        if returntype=="md":
-            resp=make_response(render_template("schema.md", schemajson=schemajson, collection=collection))
-            resp.headers['Content-type'] = 'text/markdown; charset=UTF-8'
-            return resp
-            # return render_template("schema.md", schemajson=schemajson, collection=collection)
-        if returntype=="html":
-            return render_template("schema.html", schemajson=schemajson, collection=collection, html=True,date=today)
-        if returntype=="pdf":
-            schemapdfhtml=HTML(string=render_template("schema.html", schemajson=schemajson, collection=collection))
-            resp=make_response(schemapdfhtml.write_pdf())
-            resp.headers['Content-type'] = 'application/pdf'
-            return resp
-    return(schemajson)
+    schema_stamp.check()
+    max_age=app.config.get("SCHEMA_CACHE_TTL",3600)
+    key=(collection,returntype,today)
+    etag=version_etag(collectionmap[collection],("SCHEMA",)+key,schema_stamp)
+    resp=not_modified(etag,max_age)
+    if resp is not None:
+        return resp
+    schemajson=get_schema(collectionmap[collection])
+    if returntype not in ["md","html","pdf"]:
+        return cache_headers(make_response(schemajson),etag,max_age)
+    if returntype=="pdf":
+        return schema_pdf(collection,schemajson,etag,max_age)
+    artefact=schema_artefacts.get(key)
+    if artefact is None:
+        with span("render",template="schema."+returntype):
+            if returntype=="md":
+                artefact=(render_template("schema.md", schemajson=schemajson, collection=collection),'text/markdown; charset=UTF-8')
+            if returntype=="html":
+                artefact=(render_template("schema.html", schemajson=schemajson, collection=collection, html=True,date=today),'text/html; charset=utf-8')
+        schema_artefacts.set(key,artefact)
+    resp=make_response(artefact[0])
+    resp.headers['Content-type'] = artefact[1]
+    return cache_headers(resp,etag,max_age)
+
+def schema_pdf(collection,schemajson,etag,max_age):
+    """
+    Internal function serving a schema PDF from pdf_store, or starting its render job.
+    A finished PDF is sent as a file, otherwise the response is 202 with the job, unless
+    the wait argument is true and the job finishes within PDF_RENDER_TIMEOUT. A failed render
+    is answered with 500 for PDF_FAILURE_BACKOFF seconds before it is tried again.
+    """
+    name=schema_pdf_name(collection,schemajson)
+    status=pdf_store.submit(name,lambda: render_schema_pdf(collection,schemajson),prune=collection+"-")
+    if status=="running" and request.args.get("wait")=="true":
+        pdf_store.wait(name,app.config.get("PDF_RENDER_TIMEOUT",120))
+        status=pdf_store.status(name)
+    if status=="done":
+        return send_file(pdf_store.path(name),mimetype='application/pdf',etag=etag or True,max_age=max_age,conditional=True)
+    return schema_job_response(name,status)
+
+def schema_job_response(name,status):
+    """
+    Internal function describing a schema PDF job.
+    """
+    body={"job":name,"status":status,"status-url":request.host_url+"api/schema/jobs/"+name}
+    code=202
+    if status=="done":
+        body["location"]=request.host_url+"api/schema/"+name.rsplit("-",1)[0]+".pdf"
+        code=200
+    if status=="failed":
+        body["error"]=pdf_store.error(name) or ""
+        code=500
+    resp=make_response(body,code)
+    resp.cache_control.no_store=True
+    if status=="running":
+        resp.headers['Retry-After']='2'
+    return resp
+
+@app.route("/api/schema/jobs/<job>", methods = ['GET'])
+def schema_job(job):
+    """ 
+    GET:
+        Reports a schema PDF job started by /api/schema/<collection>.pdf: running, done with the
+        location of the PDF or failed. Jobs are shared by the worker processes.
+
+        Returns: 
+            json: Job status
+    """
+    status=None
+    if job.endswith(".pdf"):
+        try:
+            status=pdf_store.status(job)
+        except ValueError:
+            pass
+    if status is None:
+        return {"error":"unknown job"}, 404
+    return schema_job_response(job,status)
+
+@app.route("/api/resources/cache/purge", methods = ['POST'])
+@admin_required
+def resources_cache_purge():
+    """ 
+    POST:
+        Purges the cached search results in every worker.
+        Used after a commit to the learningresources core.
+
+        Returns: 
+            json: Confirmation
+    """
+    results_stamp.touch()
+    return {"purged":"results"}
+
+@app.route("/api/resources/cache/popular", methods = ['GET'])
+@admin_required
+def resources_cache_popular():
+    """ 
+    GET:
+        Returns the most frequent first page searches of this worker with their request counts,
+        eg. ?limit=20. The WARM_SEARCHES most frequent are precomputed into the result cache
+        after every index change.
+
+        Returns: 
+            json: Searches and counts
+    """
+    limit=request.args.get("limit","20")
+    if not limit.isnumeric():
+        return {"error":"limit must be a positive integer"}, 400
+    popular=[]
+    for (method,host_url,query),count in search_stats.top(int(limit)):
+        if method=="POST":
+            popular.append({"method":method,"search":json.loads(query),"count":count})
+        else:
+            popular.append({"method":method,"args":[list(item) for item in query],"count":count})
+    return {"searches":popular,"warmed":search_warmer.top}
+
+@app.cli.command("purge-results")
+def purge_results_command():
+    """Purge the cached search results in every worker."""
+    results_stamp.touch()
+    click.echo("Result cache purged.")
+
+@app.route("/api/schema/invalidate", methods = ['POST'])
+@admin_required
+def schema_invalidate():
+    """ 
+    POST:
+        Drops the cached Solr schemas and rendered schema documents in every worker.
+        Used after the Solr schema of a collection is changed.
+
+        Returns: 
+            json: Confirmation
+    """
+    schema_stamp.touch()
+    return {"invalidated":"schema"}
+
+@app.cli.command("invalidate-schema")
+def invalidate_schema_command():
+    """Drop the cached Solr schemas and rendered schema documents in every worker."""
+    schema_stamp.touch()
+    click.echo("Schema cache invalidated.")
 
 
 @app.route("/api/vocabularies/", defaults={'document': None}, methods = ['GET'])
@@ -481,14 +2545,14 @@ def schema(collection,returntype):
 def vocabularies(document):
     """ 
     GET:
-        Builds Solr searches and returns results for learning resources.
+        Returns vocabularies from the in memory copy of the taxonomies core.
     
         Parameters: 
 
             request (request):  The full request made to a route.
 
         Returns: 
-            json: JSON results from Solr  
+            json: Vocabularies, vocabulary names or completed values
     POST:
         Not yet implemented
     PUT
@@ -498,6 +2562,9 @@ def vocabularies(document):
     
     ;;field:{"name":"id","type":"UUID","example":"35952525-b39c-4b50-a925-2ea52eb928b1","description":"ID of vocabulary"}
     ;;field:{"name":"name","type":"string","example":"\\\"Organizations\\\"","description":"Name of vocabulary"}
+    ;;field:{"name":"values","type":"string","example":"NASA","description":"Value in vocabulary"}
+    ;;field:{"name":"names","type":"boolean","example":"true","description":"Only return the names of all vocabularies"}
+    ;;field:{"name":"prefix","type":"string","example":"Dat","description":"Return up to limit values starting with prefix, for autocomplete"}
     ;;gettablefieldnames:["Name","Type","Example","Description"]
     """
 
@@ -510,39 +2577,35 @@ def vocabularies(document):
 
     if request.method == 'GET':
         if document!="search.json":
-            return generate_documentation(vocabularies.__doc__,document,request,True)
-        searchstring="*:*"
-        returnval= json.loads('{ "documentation":"'+request.host_url+'api/vocabularies/documentation.html","names":[]}')
-        if len(request.args)>0:
-            if request.args.get("names")=="true":
-                
-                results=taxonomies.search("*:*")
-                for result in results:
-                    returnval["names"].append(result["name"])
-                return returnval
-            else:
-                searchstring=append_searchstring(searchstring,request,"name")
-                searchstring=append_searchstring(searchstring,request,"values")
-                searchstring=append_searchstring(searchstring,request,"id")
-                returnval= json.loads('{ "documentation":"API documentation string will go here","results":[]}')
-                results=taxonomies.search(searchstring)
-                for result in results:
-                    result.pop('_version_', None)
-                    returnval["results"].append(result)
-                returnval['hits']=results.hits
-                returnval['hits-returned']=len(results)
-                return returnval
-        else:
-            returnval= json.loads('{ "documentation":"'+request.host_url+'api/vocabularies/documentation.html","results":[]}')
-            results=taxonomies.search("*:*")
-            for result in results:
-                result.pop('_version_', None)
-                returnval["results"].append(result)
-            returnval['hits']=results.hits
-            returnval['hits-returned']=len(results)
-            return returnval
+            return generate_documentation(document,request,True)
+        vocabularies_stamp.check()
+        max_age=app.config.get("RESULT_CACHE_TTL",300)
+        etag=version_etag("taxonomies",("VOCABULARIES",request.host_url,tuple(sorted(request.args.items(multi=True)))),vocabularies_stamp)
+        resp=not_modified(etag,max_age)
+        if resp is not None:
+            return resp
+        resp=make_response(lookup_vocabularies(vocabulary_index.current(),request.args,request.host_url))
+        return cache_headers(resp,etag,max_age)
 
-    
+@app.route("/api/vocabularies/refresh", methods = ['POST'])
+@admin_required
+def vocabularies_refresh():
+    """ 
+    POST:
+        Reloads the in memory vocabularies in every worker.
+        Used after the taxonomies core is changed.
+
+        Returns: 
+            json: Confirmation
+    """
+    vocabularies_stamp.touch()
+    return {"refreshed":"vocabularies"}
+
+@app.cli.command("refresh-vocabularies")
+def refresh_vocabularies_command():
+    """Reload the in memory vocabularies in every worker."""
+    vocabularies_stamp.touch()
+    click.echo("Vocabularies will be reloaded.")
 
 @app.route("/login/", methods = ['POST'])
 def login():
@@ -557,11 +2620,40 @@ def login():
         Returns: 
             cookie:session token
     """
-    user_object=get_user(request.form['username'])
+    username=request.form['username']
+    if not login_throttle.allow("user:"+username) or not login_throttle.allow("ip:"+str(request.remote_addr)):
+        resp=make_response('Too many login attempts', 429)
+        resp.headers['Retry-After']=str(login_throttle.retry_after())
+        return resp
+    user_object=get_user(username)
     if user_object:
         computed=user_object['hash']
         passwd=request.form['password']
-        if drash.verify(passwd, computed):
+        if not login_slots.acquire(blocking=False):
+            resp=make_response('Login temporarily unavailable', 503)
+            resp.headers['Retry-After']='1'
+            return resp
+        try:
+            future=login_executor.submit(verify_password,passwd,computed,app.config.get("LOGIN_HASH_COUNT",15))
+        except Exception:
+            login_slots.release()
+            raise
+        future.add_done_callback(lambda done: login_slots.release())
+        try:
+            with span("hash"):
+                verified,rehashed=future.result(timeout=app.config.get("LOGIN_TIMEOUT",10))
+        except FutureTimeoutError:
+            future.cancel()
+            resp=make_response('Login temporarily unavailable', 503)
+            resp.headers['Retry-After']='1'
+            return resp
+        if verified:
+            if rehashed:
+                try:
+                    users.add([{"id":user_object['id'],"hash":rehashed}], fieldUpdates={"hash":"set"}, commitWithin=10000)
+                except Exception:
+                    app.logger.exception("Storing the rehashed password failed.")
+            user_cache.pop(user_object['id'])
             login_user(User(user_object['id'],user_object['groups'],user_object['name']))
             return redirect(url_for('protected'))
 
@@ -571,27 +2663,118 @@ def login():
 @app.route("/logout/")
 @login_required
 def logout():
+    user_cache.pop(current_user.id)
     logout_user()
     return redirect("/")
 
 @app.route('/protected')
 @login_required
 def protected():
-    print(current_user.groups)
     return 'Logged in as: ' + current_user.name
 
 
 
+@app.before_request
+def start_request_timer():
+    g.started=time.perf_counter()
+    g.spans=[]
+
+@app.after_request
+def record_request(response):
+    """ 
+    Observes the duration of a request in the route metrics, adds the Server-Timing header
+    when SERVER_TIMING is set and logs requests slower than SLOW_REQUEST_SECONDS with their
+    timed steps and Solr queries.
+    """
+    started=g.get('started')
+    if started is None:
+        return response
+    elapsed=time.perf_counter()-started
+    route=request.endpoint or "unmatched"
+    request_metrics.observe("dmt_request_seconds",{"route":route,"method":request.method},elapsed)
+    request_metrics.inc("dmt_requests_total",{"route":route,"method":request.method,"status":str(response.status_code)})
+    if app.config.get("SERVER_TIMING",False):
+        timings=[name+";dur="+format(seconds*1000,".1f")+"".join(';desc="'+str(v)+'"' for k,v in sorted(labels.items()) if k!="span") for name,labels,seconds in g.spans]
+        timings.append("total;dur="+format(elapsed*1000,".1f"))
+        response.headers['Server-Timing']=", ".join(timings)
+    slow=app.config.get("SLOW_REQUEST_SECONDS")
+    if slow is not None and elapsed>=slow:
+        app.logger.warning("Slow request %s", json.dumps({"method":request.method,"path":request.full_path.rstrip("?"),"route":route,"status":response.status_code,
+            "seconds":round(elapsed,4),"spans":[dict(labels,span=name,seconds=round(seconds,4)) for name,labels,seconds in g.spans],
+            "solr":g.get('solr_queries',[])},default=str))
+    return response
+
+@app.route("/metrics")
+def metrics():
+    """ 
+    GET:
+        Exposes the Solr counters per core, the request histograms and counters per route and
+        the step histograms of this process in Prometheus text format.
+
+    Returns: 
+            text/plain
+    """
+    lines=[]
+    for name,kind,help in [("requests","counter","Solr requests sent"),("errors","counter","Solr requests that failed"),("retries","counter","Solr requests retried after a transient error"),("seconds","counter","Seconds spent waiting on Solr")]:
+        metric="dmt_solr_"+name+"_total"
+        lines.append("# HELP "+metric+" "+help+".")
+        lines.append("# TYPE "+metric+" "+kind)
+        for core,corestats in sorted(solr.stats.items()):
+            lines.append(metric+'{core="'+core+'"} '+str(corestats[name]))
+    lines+=request_metrics.render()
+    resp=make_response("\n".join(lines)+"\n")
+    resp.headers['Content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
 @app.route("/")
 def hello():
     return "DMT Clearinghouse."
 
 @app.route("/static/<path:path>")
 def send_static(path):
-    print(path)
     return send_from_file('static',path)
 
 
+#Parse the ;; api lines of every route once at import.
+route_docs={endpoint:parse_docstring(view.__doc__) for endpoint,view in app.view_functions.items()}
+#Searchable learning resource fields, from the same ;;field lines that feed the documentation and the facets.
+resource_fields={field['name']:field for field in route_docs['learning_resources']['parameters'] if field['name'] not in ["limit","cursor","stream","fields","highlight"]}
+for rf in resources_facets:
+    resource_fields.setdefault(rf.replace('facet_',''),{"name":rf.replace('facet_',''),"type":"string"})
+
+def create_app(warm=False):
+    """ 
+    Returns the configured app, for WSGI files and servers that prefork workers eg.
+
+        application = create_app(warm=True)
+
+    Importing the module only builds the app, Solr clients, password hashing and WeasyPrint
+    are loaded on first use. With warm they are imported and the field plan, vocabularies and
+    suggestions are fetched up front, so workers forked afterwards serve their first request warm.
+    WeasyPrint is only preloaded with PDF_PRELOAD. Connections opened while warming are
+    closed so forked workers never share a socket.
+
+    Parameters: 
+
+        warm (bool): Load dependencies and Solr backed data now instead of on first use.
+
+    Returns: 
+    Flask: The app
+    """
+    if warm:
+        import pysolr
+        import requests
+        import drupal_hash_utility
+        if app.config.get("PDF_PRELOAD",False):
+            import weasyprint
+        resource_plan()
+        try:
+            vocabulary_index.current()
+            suggest_index.current()
+        except Exception:
+            app.logger.warning("Vocabularies or suggestions could not be loaded while warming, they will be loaded on first use.")
+        solr.close()
+    return app
+
 if __name__ == "__main__":
     app.run()
-
@@ -0,0 +1,340 @@
+"""
+Optional async serving mode of the DMT Clearinghouse API.
+
+Searches on /api/resources/, vocabulary lookups on /api/vocabularies/ and JSON schemas
+on /api/schema/ are answered here with an async HTTP client against Solr, so a single
+worker holds many requests in flight while waiting on Solr and a structured search
+fetches its results and facet counts concurrently. Every other request (documentation,
+html/md/pdf schemas, export, login) is passed to the Flask app on a thread.
+
+Requires httpx and asgiref. Serve with any ASGI server eg.
+
+    uvicorn dmtclearinghouse_asgi:application --workers 2
+"""
+import asyncio
+import hashlib
+import json
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+import pysolr
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+
+import dmtclearinghouse as dmt
+
+app = dmt.create_app()
+flask_application = WsgiToAsgi(app)
+
+
+class AsyncSolr(object):
+    """
+    Async counterpart of SolrPool. Shares its address, timeouts, retry settings and
+    per core counters, so /metrics covers both serving modes.
+
+    Parameters:
+
+        pool (SolrPool): The synchronous client layer of the app.
+
+        max_connections (int): Maximum number of concurrent connections to Solr.
+    """
+    def __init__(self,pool,max_connections=100):
+        self.pool = pool
+        self.max_connections = max_connections
+        self.client = None
+
+    def session(self):
+        if self.client is None:
+            limits=httpx.Limits(max_connections=self.max_connections,max_keepalive_connections=self.max_connections)
+            self.client=httpx.AsyncClient(limits=limits)
+        return self.client
+
+    def is_transient(self,error):
+        if isinstance(error,(httpx.TransportError,httpx.TimeoutException)):
+            return True
+        return isinstance(error,httpx.HTTPStatusError) and error.response.status_code in (502,503,504)
+
+    async def get_json(self,core,path,params=None,operation="search"):
+        """
+        Performs a GET against a core handler with retries on transient errors.
+        """
+        attempt=0
+        while True:
+            started=time.perf_counter()
+            try:
+                r=await self.session().get(self.pool.address+core+"/"+path, params=params, timeout=self.pool.timeouts[operation])
+                r.raise_for_status()
+                result=r.json()
+            except Exception as error:
+                retry=attempt<self.pool.retries and self.is_transient(error)
+                self.pool.record(core,started,error=True,retry=retry)
+                if not retry:
+                    raise
+                await asyncio.sleep(self.pool.backoff*(2**attempt))
+                attempt+=1
+                continue
+            self.pool.record(core,started)
+            return result
+
+    async def search(self,core,params):
+        """
+        Runs a select on core and returns pysolr Results, so the formatters of the app can be used.
+        """
+        params=dict(params)
+        params['wt']='json'
+        return pysolr.Results(await self.get_json(core,"select",list(flatten(params))))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client=None
+
+
+def flatten(params):
+    #Expands list values into repeated parameters like pysolr does.
+    for key,value in params.items():
+        if isinstance(value,(list,tuple)):
+            for item in value:
+                yield key,item
+        else:
+            yield key,value
+
+
+solr = AsyncSolr(dmt.solr,max_connections=app.config.get("ASYNC_SOLR_CONNECTIONS",100))
+
+
+async def resource_plan():
+    #The plan is cached with the schema, only a cold cache needs a thread.
+    plan=dmt.schema_cache.get(("plan","learningresources"))
+    if plan is None:
+        plan=await asyncio.to_thread(dmt.resource_plan)
+    return plan
+
+
+async def search_get(args,host_url):
+    await resource_plan()
+    params=dmt.get_search_params(args)
+    results=await solr.search("learningresources",params)
+    return dmt.format_resource(results,host_url)
+
+
+async def search_post(content,host_url):
+    await resource_plan()
+    params,facets=dmt.post_search_params(content)
+    searches=[solr.search("learningresources",params)]
+    if facets:
+        searches.append(solr.search("learningresources",{"q":params['q'],"fq":params['fq'],"rows":0,**dmt.json_facet_params(facets)}))
+    responses=await asyncio.gather(*searches)
+    returnval=dmt.format_resource(responses[0],host_url)
+    if facets:
+        returnval['facets']=dmt.format_json_facets(responses[1].raw_response,facets)
+    return returnval
+
+
+async def version_etag(core,key,stamp):
+    #A due index version poll runs on a thread so the event loop never waits on Solr.
+    if dmt.index_versions.due(core):
+        await asyncio.to_thread(dmt.index_versions.poll,core)
+    return dmt.version_etag(core,key,stamp)
+
+
+def cache_headers(etag,max_age):
+    headers={"cache-control":"public, max-age="+str(max_age)}
+    if etag is not None:
+        headers["etag"]='"'+etag+'"'
+    return headers
+
+
+def not_modified(scope,etag):
+    return etag is not None and parse_etags(header(scope,"if-none-match") or None).contains(etag)
+
+
+async def cached_search(scope,key,search):
+    """
+    Async counterpart of cached_search, sharing the result cache, the version ETags and their headers.
+    """
+    dmt.results_stamp.check()
+    max_age=app.config.get("RESULT_CACHE_TTL",300)
+    etag=await version_etag("learningresources",key,dmt.results_stamp)
+    dmt.search_warmer.check()
+    if not_modified(scope,etag):
+        return 304,b"",cache_headers(etag,max_age)
+    cached=dmt.result_cache.get(key)
+    if cached is None:
+        try:
+            returnval=await search()
+        except dmt.SearchQueryError as error:
+            return 400,json_body({"error":str(error)}),{}
+        body=json_body(returnval)
+        cached=(body,hashlib.sha1(body).hexdigest())
+        dmt.result_cache.set(key,cached)
+    etag=etag or cached[1]
+    if not_modified(scope,etag):
+        return 304,b"",cache_headers(etag,max_age)
+    return 200,cached[0],cache_headers(etag,max_age)
+
+
+async def resources_route(scope,receive,host_url):
+    if scope['method']=="GET":
+        args=query_args(scope)
+        key=("GET",host_url,tuple(sorted(args.items(multi=True))))
+        dmt.record_search(key,cursor=args.get("cursor"))
+        return await cached_search(scope,key,lambda: search_get(args,host_url))
+    if not header(scope,"content-type").startswith("application/json"):
+        return 200,b"json not found",{"content-type":"text/html; charset=utf-8"}
+    try:
+        content=json.loads(await read_body(receive))
+    except ValueError:
+        return 400,json_body({"error":"json body is not valid"}),{}
+    if not isinstance(content,dict):
+        return 400,json_body({"error":"json body must be an object"}),{}
+    key=("POST",host_url,json.dumps(content,sort_keys=True))
+    dmt.record_search(key,content.get("offset"),content.get("cursor"))
+    return await cached_search(scope,key,lambda: search_post(content,host_url))
+
+
+async def vocabularies_route(scope,receive,host_url):
+    dmt.vocabularies_stamp.check()
+    args=query_args(scope)
+    max_age=app.config.get("RESULT_CACHE_TTL",300)
+    etag=await version_etag("taxonomies",("VOCABULARIES",host_url,tuple(sorted(args.items(multi=True)))),dmt.vocabularies_stamp)
+    if not_modified(scope,etag):
+        return 304,b"",cache_headers(etag,max_age)
+    index=dmt.vocabulary_index
+    if index.loaded is None or time.monotonic()-index.loaded>index.refresh:
+        await asyncio.to_thread(index.current)
+    return 200,json_body(dmt.lookup_vocabularies(index,args,host_url)),cache_headers(etag,max_age)
+
+
+async def schema_route(scope,receive,host_url,collection):
+    collectionmap={"resources":"learningresources","learningresources":"learningresources","vocabularies":"taxonomies","taxonomies":"taxonomies","user":"users","users":"users"}
+    core=collectionmap[collection]
+    dmt.schema_stamp.check()
+    max_age=app.config.get("SCHEMA_CACHE_TTL",3600)
+    key=(collection,"json",dmt.date.today().strftime("%d/%m/%Y"))
+    etag=await version_etag(core,("SCHEMA",)+key,dmt.schema_stamp)
+    if not_modified(scope,etag):
+        return 304,b"",cache_headers(etag,max_age)
+    schemajson=dmt.schema_cache.get(core)
+    if schemajson is None:
+        fields=(await solr.get_json(core,"schema/fields",operation="schema"))['fields']
+        schemajson=dmt.schema_from_fields(fields)
+        dmt.schema_cache.set(core,schemajson)
+    return 200,json_body(schemajson),cache_headers(etag,max_age)
+
+
+def route(scope):
+    """
+    Returns the Flask endpoint name and async handler of a request, or None when the Flask app handles it.
+    """
+    path=scope['path']
+    method=scope['method']
+    if path in ("/api/resources/","/api/resources/search.json") and method in ("GET","POST"):
+        if method=="GET" and query_args(scope).get("stream")=="true":
+            return None
+        return "learning_resources",resources_route
+    if path in ("/api/vocabularies/","/api/vocabularies/search.json") and method=="GET":
+        return "vocabularies",vocabularies_route
+    if path.startswith("/api/schema/") and path.endswith(".json") and method=="GET":
+        collection=path[len("/api/schema/"):-len(".json")]
+        if collection in ("resources","learningresources","vocabularies","taxonomies","user","users"):
+            return "schema",lambda scope,receive,host_url: schema_route(scope,receive,host_url,collection)
+    return None
+
+
+def header(scope,name):
+    for key,value in scope.get('headers',[]):
+        if key.decode('latin-1').lower()==name:
+            return value.decode('latin-1')
+    return ""
+
+
+def query_args(scope):
+    return MultiDict(parse_qsl(scope.get('query_string',b"").decode('utf-8'),keep_blank_values=True))
+
+
+def host_url(scope):
+    host=header(scope,"host")
+    if not host and scope.get('server'):
+        host="%s:%s"%tuple(scope['server'])
+    return scope.get('scheme','http')+"://"+host+scope.get('root_path','')+"/"
+
+
+def json_body(value):
+    #Same serialization as the Flask app so cached bodies are shared between serving modes.
+    return app.json.response(value).get_data()
+
+
+async def read_body(receive):
+    body=b""
+    while True:
+        message=await receive()
+        body+=message.get('body',b"")
+        if not message.get('more_body'):
+            return body
+
+
+def stream_requested(body):
+    #True for a POST search asking for a streamed response.
+    if b'"stream"' not in body:
+        return False
+    try:
+        content=json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(content,dict) and content.get("stream") is True
+
+
+def replay_body(body,receive):
+    #Receive callable handing an already read body to the Flask app, then the following messages.
+    pending=[{"type":"http.request","body":body,"more_body":False}]
+    async def replay():
+        if pending:
+            return pending.pop()
+        return await receive()
+    return replay
+
+
+async def application(scope,receive,send):
+    """
+    ASGI entry point.
+    """
+    if scope['type']=="lifespan":
+        while True:
+            message=await receive()
+            if message['type']=="lifespan.startup":
+                await send({"type":"lifespan.startup.complete"})
+            elif message['type']=="lifespan.shutdown":
+                await solr.close()
+                await send({"type":"lifespan.shutdown.complete"})
+                return
+    routed=None
+    if scope['type']=="http":
+        routed=route(scope)
+        #Streamed searches are answered by the Flask app, which sends them in chunks of STREAM_PAGE_SIZE.
+        if routed is not None and scope['method']=="POST":
+            body=await read_body(receive)
+            receive=replay_body(body,receive)
+            if stream_requested(body):
+                routed=None
+    if routed is None:
+        return await flask_application(scope,receive,send)
+    endpoint,handler=routed
+    started=time.perf_counter()
+    try:
+        status,body,headers=await handler(scope,receive,host_url(scope))
+    except Exception:
+        app.logger.exception("Async request to %s failed.",scope['path'])
+        status,body,headers=500,json_body({"error":"Internal Server Error"}),{}
+    elapsed=time.perf_counter()-started
+    dmt.request_metrics.observe("dmt_request_seconds",{"route":endpoint,"method":scope['method']},elapsed)
+    dmt.request_metrics.inc("dmt_requests_total",{"route":endpoint,"method":scope['method'],"status":str(status)})
+    slow=app.config.get("SLOW_REQUEST_SECONDS")
+    if slow is not None and elapsed>=slow:
+        app.logger.warning("Slow request %s", json.dumps({"method":scope['method'],"path":scope['path'],"route":endpoint,"status":status,"seconds":round(elapsed,4)}))
+    headers.setdefault("content-type","application/json")
+    headers["content-length"]=str(len(body))
+    await send({"type":"http.response.start","status":status,"headers":[(k.encode('latin-1'),v.encode('latin-1')) for k,v in headers.items()]})
+    await send({"type":"http.response.body","body":body if scope['method']!="HEAD" else b""})